@@ -1,3 +1,439 @@
+import re
+import asyncio
+import logging
+from time import monotonic
+from struct import pack, unpack
+from collections import OrderedDict
+from rapidjson import loads, dumps
+
+logger = logging.getLogger(__name__)
+
+
+OFFSET_RE = re.compile(r'^[0-9a-f]{16}(?:[0-9a-f]{32})?$')
+
+# errors of bad arguments or missing items, not of failed database
+CLIENT_ERRORS = (AssertionError, LookupError, TypeError, ValueError)
+
+# list filters and document fields they are indexed by, together with ts
+LIST_FILTERS = {
+    'owner': 'envelope.owner',
+    'model': 'envelope.model',
+    'tender': 'envelope.payload.tender',
+}
+
+
+# stats counters are kept by (kind, key, model), kinds are
+STATS_KINDS = ('tender', 'owner', 'model', 'day')
+
+
+def dump_item(doc):
+    return dumps(doc, ensure_ascii=False).encode('utf-8')
+
+
+def list_filter(filters):
+    """Return (name, value) of single list filter or None"""
+    if not filters:
+        return None
+    if len(filters) > 1:
+        raise ValueError('only one filter allowed')
+    name, value = next(iter(filters.items()))
+    if name not in LIST_FILTERS:
+        raise ValueError('unknown filter')
+    return name, value
+
+
+def pack_offset(ts, item_id=None):
+    """Encode list cursor, packed ts followed by id of the item"""
+    if ts is None:
+        return None
+    return pack('d', ts).hex() + (item_id or '')
+
+
+def unpack_offset(offset):
+    """Decode list cursor to (ts, id), id is None for old ts only offsets"""
+    if not offset or not OFFSET_RE.match(offset):
+        raise ValueError('bad offset')
+    ts = unpack('d', bytes.fromhex(offset[:16]))[0]
+    return ts, offset[16:] or None
+
+
+def check_found(items_ids, found, table='data'):
+    """Assert all of items_ids are in found set, like check_exists"""
+    missing = [item_id for item_id in items_ids if item_id not in found]
+    assert not missing, '{} not found in {}'.format(', '.join(missing), table)
+    return True
+
+
+def stats_id(kind, key, model=''):
+    """Counter id, without model it is the prefix of all key counters"""
+    return '{}:{}:{}'.format(kind, key, model)
+
+
+def stats_keys(data):
+    """Return (kind, key, model) counters of one item"""
+    envelope = data['envelope']
+    model = envelope['model']
+    keys = [
+        ('model', model, model),
+        ('owner', envelope['owner'], model),
+        ('day', envelope['date'][:10], model),
+    ]
+    payload = envelope.get('payload')
+    if isinstance(payload, dict) and payload.get('tender'):
+        keys.append(('tender', payload['tender'], model))
+    return keys
+
+
+def count_stats(items, counts=None):
+    """Return dict of counter id increments for given items"""
+    if counts is None:
+        counts = dict()
+    for data in items:
+        for keys in stats_keys(data):
+            counter_id = stats_id(*keys)
+            counts[counter_id] = counts.get(counter_id, 0) + 1
+    return counts
+
+
+def stats_models(prefix, rows):
+    """Return counts by model from (counter id, count) rows of one prefix"""
+    models = dict()
+    for counter_id, count in rows:
+        model = counter_id[len(prefix):]
+        # skip counters of longer keys which share the prefix
+        if counter_id.startswith(prefix) and ':' not in model:
+            models[model] = count
+    return models
+
+
+class ItemCache(object):
+    """LRU cache of immutable item documents bounded by count and size
+
+    Documents are kept serialized so the memory budget is accounted
+    exactly and cached items can't be changed by callers.
+    """
+    def __init__(self, max_items=10000, max_bytes=64 * 1024 * 1024):
+        self.max_items = int(max_items)
+        self.max_bytes = int(max_bytes)
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item_id):
+        return item_id in self.items
+
+    def get(self, item_id):
+        data = self.get_data(item_id)
+        if data is None:
+            return None
+        return loads(data)
+
+    def get_data(self, item_id):
+        try:
+            data = self.items[item_id]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(item_id)
+        self.hits += 1
+        return data
+
+    def put(self, item_id, doc):
+        if item_id in self.items:
+            self.items.move_to_end(item_id)
+            return
+        self.put_data(item_id, dump_item(doc))
+
+    def put_data(self, item_id, data):
+        if item_id in self.items or len(data) > self.max_bytes:
+            return
+        self.items[item_id] = data
+        self.size += len(data)
+        while len(self.items) > self.max_items or self.size > self.max_bytes:
+            _, data = self.items.popitem(last=False)
+            self.size -= len(data)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class CachedEngine(object):
+    """Database engine proxy which serves items from ItemCache
+
+    Stored items are never changed, so cache entries are never invalidated.
+    """
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def close(self):
+        logger.info('Item cache stats {}'.format(self.cache.stats()))
+        await self.engine.close()
+        if hasattr(self.cache, 'close'):
+            self.cache.close()
+
+    async def get_item(self, item_id, table='data'):
+        if table != 'data':
+            return await self.engine.get_item(item_id, table=table)
+        doc = self.cache.get(item_id)
+        if doc is None:
+            doc = await self.engine.get_item(item_id, table=table)
+            if doc:
+                self.cache.put(item_id, doc)
+        return doc
+
+    async def get_many(self, items_list, table='data'):
+        if table != 'data':
+            return await self.engine.get_many(items_list, table=table)
+        return [loads(data) for data in await self.get_many_raw(items_list)]
+
+    async def get_many_raw(self, items_list, table='data'):
+        found = dict()
+        missing = list()
+        for item_id in items_list:
+            data = self.cache.get_data(item_id)
+            if data is None:
+                missing.append(item_id)
+            else:
+                found[item_id] = data
+        if missing:
+            for doc in await self.engine.get_many(missing, table=table):
+                data = dump_item(doc)
+                self.cache.put_data(doc['id'], data)
+                found[doc['id']] = data
+        return [found[i] for i in items_list if i in found]
+
+    async def put_item(self, data, table='data'):
+        if table != 'data':
+            return await self.engine.put_item(data, table=table)
+        # engines change data in place, so serialize it before insert
+        item_id = data['id']
+        raw = dump_item(data)
+        result = await self.engine.put_item(data, table=table)
+        self.cache.put_data(item_id, raw)
+        return result
+
+    async def put_many(self, items, table='data'):
+        if table != 'data':
+            return await self.engine.put_many(items, table=table)
+        raw_list = [(data['id'], dump_item(data)) for data in items]
+        result = await self.engine.put_many(items, table=table)
+        for (item_id, raw), status in zip(raw_list, result):
+            if status == 'created':
+                self.cache.put_data(item_id, raw)
+        return result
+
+
+class StatsEngine(object):
+    """Database engine proxy which counts created items in stats table
+
+    Counters are incremented after insert, so they can fall behind if
+    update fails, in that case cdb_stats rebuilds them from data table.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def increment(self, counts):
+        try:
+            await self.engine.update_stats(counts)
+        except Exception:   # pragma: no cover
+            logger.exception('Stats not updated')
+
+    async def put_item(self, data, table='data'):
+        result = await self.engine.put_item(data, table=table)
+        if table == 'data':
+            await self.increment(count_stats([data]))
+        return result
+
+    async def put_many(self, items, table='data'):
+        result = await self.engine.put_many(items, table=table)
+        created = [data for data, status in zip(items, result) if status == 'created']
+        if table == 'data' and created:
+            await self.increment(count_stats(created))
+        return result
+
+
+class BatchedEngine(object):
+    """Database engine proxy which coalesces concurrent put_item calls
+
+    Items are queued and stored by one put_many when max_size items are
+    waiting or max_delay seconds after the first one, so ingest bursts
+    take one database round trip per batch. Each caller gets the status
+    of own item.
+    """
+    def __init__(self, engine, max_size=100, max_delay=0.005):
+        self.engine = engine
+        self.max_size = int(max_size)
+        self.max_delay = float(max_delay)
+        self.pending = list()
+        self.timer = None
+        self.tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def close(self):
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.engine.close()
+
+    async def put_item(self, data, table='data'):
+        if table != 'data':
+            return await self.engine.put_item(data, table=table)
+        # engines change data in place, id may be moved
+        item_id = data['id']
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((data, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.max_delay, self.flush)
+        status = await future
+        if status == 'duplicate':
+            logger.error('Duplicate id {}'.format(item_id))
+            raise ValueError('{} already exists'.format(item_id))
+        if status != 'created':
+            raise RuntimeError('insert error')
+        return True
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, list()
+        task = asyncio.ensure_future(self.write(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def write(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            result = await self.engine.put_many([data for data, _ in batch])
+        except Exception as e:
+            logger.exception('Batch of {} not stored'.format(len(batch)))
+            result = [e] * len(batch)
+        for (_, future), status in zip(batch, result):
+            # caller may be gone already
+            if future.done():
+                continue
+            if isinstance(status, Exception):
+                future.set_exception(status)
+            else:
+                future.set_result(status)
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'batches': self.batches,
+            'items': self.items
+        }
+
+
+class ReplicatedEngine(object):
+    """Database engine proxy which sends reads to replicas
+
+    Replicas are used round robin, one that fails is excluded for
+    retry_after seconds and the read goes to primary, all other calls go
+    to primary. With read_your_writes items not found on replica are read
+    again from primary, so item just stored by any worker can be fetched
+    right after PUT despite replication lag.
+    """
+    READ_METHODS = ('get_list', 'get_item', 'get_many', 'get_many_raw', 'check_exists',
+                    'check_exists_many', 'get_stats')
+
+    def __init__(self, engine, replicas, read_your_writes=True, retry_after=30):
+        self.engine = engine
+        self.replicas = list(replicas)
+        self.read_your_writes = bool(read_your_writes)
+        self.retry_after = float(retry_after)
+        self.down_till = [0.0] * len(self.replicas)
+        self.next = 0
+        self.reads = 0
+        self.errors = 0
+        self.fallbacks = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.engine, name)
+        if name not in self.READ_METHODS:
+            return attr
+
+        async def read(*args, **kwargs):
+            return await self.read(name, *args, **kwargs)
+        setattr(self, name, read)
+        return read
+
+    async def close(self):
+        for replica in self.replicas:
+            await replica.close()
+        await self.engine.close()
+
+    def choose(self):
+        now = monotonic()
+        for _ in range(len(self.replicas)):
+            n = self.next
+            self.next = (n + 1) % len(self.replicas)
+            if self.down_till[n] <= now:
+                return n
+        return None
+
+    @staticmethod
+    def is_complete(name, result, args, kwargs):
+        if name == 'get_item':
+            return result is not None
+        if name in ('get_many', 'get_many_raw'):
+            items_list = args[0] if args else kwargs['items_list']
+            return len(result) == len(items_list)
+        return True
+
+    async def read(self, name, *args, **kwargs):
+        n = self.choose()
+        if n is not None:
+            self.reads += 1
+            try:
+                result = await getattr(self.replicas[n], name)(*args, **kwargs)
+                if not self.read_your_writes or self.is_complete(name, result, args, kwargs):
+                    return result
+            except CLIENT_ERRORS:
+                if not self.read_your_writes or not name.startswith('check_exists'):
+                    raise
+            except Exception as e:
+                self.errors += 1
+                self.down_till[n] = monotonic() + self.retry_after
+                logger.warning('Replica {} excluded for {}s after {}: {}'.format(
+                    n, self.retry_after, e.__class__.__name__, e))
+            self.fallbacks += 1
+        return await getattr(self.engine, name)(*args, **kwargs)
+
+    def stats(self):
+        now = monotonic()
+        return {
+            'replicas': len(self.replicas),
+            'down': len([till for till in self.down_till if till > now]),
+            'reads': self.reads,
+            'errors': self.errors,
+            'fallbacks': self.fallbacks
+        }
 
 
 def get_middleware(config):
@@ -14,19 +450,77 @@ def get_middleware(config):
     return None
 
 
-async def init_engine(app):
-    config = app['config']
-    engine_name = config['database']['engine']
+def new_engine(engine_name):
     if engine_name == 'couch':
         from .couch.engine import CouchEngine
-        engine = CouchEngine()
+        return CouchEngine()
     elif engine_name == 'mongo':
         from .mongo.engine import MongoEngine
-        engine = MongoEngine()
+        return MongoEngine()
     elif engine_name == 'rethink':
         from .rethink.engine import RethinkEngine
-        engine = RethinkEngine()
-    else:
-        raise ValueError('Unknown database engine: %s' % engine_name)
-    await engine.init_engine(app)
+        return RethinkEngine()
+    elif engine_name == 'sqlite':
+        from .sqlite.engine import SqliteEngine
+        return SqliteEngine()
+    raise ValueError('Unknown database engine: %s' % engine_name)
+
+
+async def open_engine(config, options):
+    engine = new_engine(options['engine'])
+    await engine.init_engine({'config': dict(config, database=options)})
+    # migrations are run by cdb_migrate, not by each starting worker
+    try:
+        missing = await engine.check_tables()
+    except Exception as e:   # pragma: no cover
+        logger.warning('Database not checked: {}'.format(e))
+        missing = None
+    if missing:
+        logger.warning('Database is not up to date, run cdb_migrate, missing {}'.format(
+            ', '.join(missing)))
     return engine
+
+
+async def open_replicas(config, options, replicas):
+    engines = list()
+    for replica in replicas:
+        try:
+            engines.append(await open_engine(config, dict(options, **replica)))
+        except Exception as e:
+            logger.warning('Replica {} not opened: {}'.format(replica, e))
+    return engines
+
+
+async def init_engine(app):
+    config = app['config']
+    options = dict(config['database'])
+    replicas = options.pop('replicas', None)
+    routing = dict()
+    for name in ('read_your_writes', 'retry_after'):
+        if name in options:
+            routing[name] = options.pop(name)
+    engine = await open_engine(config, options)
+    if replicas:
+        replicas = await open_replicas(config, options, replicas)
+    if replicas:
+        engine = app['replicas'] = ReplicatedEngine(engine, replicas, **routing)
+    app['db'] = engine
+    if config.get('metrics', True):
+        from dozorro.api.metrics import MeteredEngine
+        app['db'] = MeteredEngine(engine)
+    if config.get('stats'):
+        app['db'] = StatsEngine(app['db'])
+    if config.get('write_batch'):
+        options = config['write_batch']
+        if not isinstance(options, dict):
+            options = {}
+        app['db'] = app['write_batch'] = BatchedEngine(app['db'], **options)
+    if config.get('cache'):
+        options = dict(config['cache'])
+        if options.get('shared'):
+            from .shared_cache import SharedItemCache
+            cache = SharedItemCache(**options)
+        else:
+            cache = ItemCache(**options)
+        app['db'] = CachedEngine(app['db'], cache)
+    return app['db']
@@ -1,8 +1,10 @@
 import logging
 from time import time
-from struct import pack, unpack
+from aiohttp import TCPConnector
 from aiocouch import CouchDB, ConflictError, NotFoundError
 from contextlib import suppress
+from rapidjson import dumps
+from dozorro.api.backend import check_found, list_filter, pack_offset, unpack_offset
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +18,42 @@ class CouchEngine(object):
                         emit(doc.ts, null)
                     }
                 }""",
-            }
+            },
+            "by_owner": {
+                "map": """function (doc) {
+                    if (doc.type == 'data') {
+                        emit([doc.envelope.owner, doc.ts], null)
+                    }
+                }""",
+            },
+            "by_model": {
+                "map": """function (doc) {
+                    if (doc.type == 'data') {
+                        emit([doc.envelope.model, doc.ts], null)
+                    }
+                }""",
+            },
+            "by_tender": {
+                "map": """function (doc) {
+                    if (doc.type == 'data' && doc.envelope.payload && doc.envelope.payload.tender) {
+                        emit([doc.envelope.payload.tender, doc.ts], null)
+                    }
+                }""",
+            },
+            "stats": {
+                "map": """function (doc) {
+                    if (doc.type == 'data') {
+                        var env = doc.envelope, model = env.model
+                        emit(['model', model, model], null)
+                        emit(['owner', env.owner, model], null)
+                        emit(['day', env.date.substr(0, 10), model], null)
+                        if (env.payload && env.payload.tender) {
+                            emit(['tender', env.payload.tender, model], null)
+                        }
+                    }
+                }""",
+                "reduce": "_count",
+            },
         },
         "validate_doc_update": """function(newDoc, oldDoc, userCtx, secObj) {
             if (newDoc._deleted === true) {
@@ -36,6 +73,9 @@ class CouchEngine(object):
         self.options = dict(app['config']['database'])
         assert self.options.pop('engine', 'couch') == 'couch'
         self.db_name = self.options.pop('database', 'dozorro')
+        if 'pool_max' in self.options:
+            limit = int(self.options.pop('pool_max'))
+            self.options['connector'] = TCPConnector(limit=limit, limit_per_host=limit)
         self.couch = CouchDB(**self.options)
         with suppress(NotFoundError):
             self.db = await self.couch[self.db_name]
@@ -45,43 +85,47 @@ class CouchEngine(object):
     async def close(self):
         await self.couch.close()
 
-    def pack_offset(self, offset):
-        if offset is None:
-            return offset
-        return pack('d', offset).hex()
-
-    def unpack_offset(self, offset):
-        if not offset or len(offset) != 16:
-            raise ValueError('bad offset')
-        return unpack('d', bytes.fromhex(offset))[0]
-
-    async def get_list(self, offset=None, limit=100, reverse=False, table='data'):
+    async def get_list(self, offset=None, limit=100, reverse=False, table='data',
+                       filters=None):
         params = {'limit': limit}
+        view = self.view
+        flt = list_filter(filters)
+        if flt:
+            # compound [value, ts] keys, {} sorts after any ts
+            view = self.db.view('data', 'by_' + flt[0])
+            params['startkey'] = dumps([flt[1], {}] if reverse else [flt[1]])
+            params['endkey'] = dumps([flt[1]] if reverse else [flt[1], {}])
+        skip = None
         if offset:
-            offset = self.unpack_offset(offset)
-            params['startkey'] = offset
-            params['limit'] += 1
+            ts, item_id = unpack_offset(offset)
+            params['startkey'] = dumps([flt[1], ts]) if flt else ts
+            # view rows with equal key are ordered by doc id
+            if item_id:
+                params['startkey_docid'] = item_id
+                params['limit'] += 1
+                skip = (ts, item_id)
+            else:
+                # old offsets have only ts, start after all items with that ts
+                params['startkey_docid'] = '' if reverse else '\uffff'
         if reverse:
             params['descending'] = 'true'
         items_list = list()
-        first_ts = None
-        last_ts = None
-
-        async for res in self.view.get(**params):
-            last_ts = res['key']
-            if not first_ts:
-                first_ts = last_ts
-                if offset and offset == first_ts:
-                    continue
-            doc = {"id": res["id"]}
-            items_list.append(doc)
+        first = None
+        last = None
+
+        for res in (await view.get(**params)).rows:
+            key = res['key'][-1] if flt else res['key']
+            row = (key, res['id'])
+            if row == skip or len(items_list) >= limit:
+                continue
+            last = row
+            if not first:
+                first = row
+            items_list.append({'id': res['id']})
 
-        if items_list:
-            first_ts = self.pack_offset(first_ts)
-            last_ts = self.pack_offset(last_ts)
-        elif last_ts:
-            first_ts, last_ts = None, None
-        return (items_list, first_ts, last_ts)
+        first = pack_offset(*first) if first else None
+        last = pack_offset(*last) if last else None
+        return (items_list, first, last)
 
     def transform_outgoing(self, doc):
         doc['id'] = doc.pop('_id')
@@ -116,10 +160,31 @@ class CouchEngine(object):
                 docs_list.append(data)
         return docs_list
 
+    async def changes(self, table='data'):
+        # continuous feed sends heartbeats, reconnects go on from last seq
+        since = 'now'
+        while True:
+            async for event in self.db.changes(feed='continuous', since=since,
+                                               include_docs=True):
+                since = event.sequence
+                doc = event.json.get('doc')
+                # data documents can't be changed, so each one is new
+                if not doc or doc.get('type') != table:
+                    continue
+                self.transform_outgoing(doc)
+                yield doc
+
     async def check_exists(self, item_id, table='data', model=None):
         await self.db.get(item_id)
         return True
 
+    async def check_exists_many(self, items_ids, table='data'):
+        found = set()
+        if items_ids:
+            # posted as keys, rows of missing ids are skipped by ids()
+            found.update([item_id async for item_id in self.db.all_docs.ids(items_ids)])
+        return check_found(items_ids, found, table)
+
     async def put_item(self, data, table='data'):
         data['ts'] = time()
         data['type'] = table
@@ -132,11 +197,63 @@ class CouchEngine(object):
             raise ValueError('{} already exists'.format(doc_id))
         return True
 
+    async def put_many(self, items, table='data'):
+        ts = time()
+        for n, data in enumerate(items):
+            data['ts'] = ts + n * 1e-6
+            data['type'] = table
+            data['_id'] = data.pop('id')
+        result = list()
+        for res in await self.db._bulk_docs(items):
+            if res.get('ok'):
+                result.append('created')
+            elif res.get('error') == 'conflict':
+                result.append('duplicate')
+            else:   # pragma: no cover
+                logger.error('{} {} for {}'.format(res.get('error'), res.get('reason'), res['id']))
+                result.append('error')
+        return result
+
+    async def get_stats(self, kind, key):
+        params = {'startkey': dumps([kind, key]), 'endkey': dumps([kind, key, {}]),
+                  'group': 'true'}
+        view = self.db.view('data', 'stats')
+        # reduced result has no offset and total_rows which View.get expects
+        res = await view._get(**params)
+        return {row['key'][2]: row['value'] for row in res['rows']}
+
+    async def update_stats(self, counts):
+        # stats view is reduced incrementally by couch itself, no side table
+        return
+
+    async def clear_stats(self):
+        return
+
     async def update_design(self):
         db = await self.couch[self.db_name]
-        ddoc = await db.create("_design/data", exists_ok=True, data=self.DESIGN)
+        ddoc = await db.create("_design/data", exists_ok=True)
+        # saved only when changed, new views are built on first query
+        ddoc.update(self.DESIGN)
         await ddoc.save()
 
+    async def update_tables(self):
+        if getattr(self, 'db', None) is not None:
+            await self.update_design()
+
+    async def check_tables(self):
+        if getattr(self, 'db', None) is None:
+            return []
+        try:
+            ddoc = await self.db.get('_design/data')
+        except NotFoundError:
+            return ['_design/data']
+        views = ddoc.get('views') or {}
+        missing = [name for name, view in self.DESIGN['views'].items()
+                   if views.get(name) != view]
+        if ddoc.get('validate_doc_update') != self.DESIGN['validate_doc_update']:
+            missing.append('validate_doc_update')
+        return missing
+
     async def init_tables(self, drop_database=False):
         dbs_list = await self.couch.keys()
         if drop_database and self.db_name in dbs_list:
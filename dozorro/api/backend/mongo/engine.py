@@ -1,14 +1,20 @@
 import logging
 from time import time
-from struct import pack, unpack
 from motor import motor_asyncio
-from pymongo import ASCENDING, DESCENDING
-from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from pymongo.son_manipulator import SONManipulator
+from dozorro.api.backend import LIST_FILTERS, check_found, list_filter, pack_offset, stats_id, \
+    stats_models, unpack_offset
 
 
 logger = logging.getLogger(__name__)
 
+TS_ID_INDEX = [('ts', ASCENDING), ('_id', ASCENDING)]
+
+FILTER_INDEXES = {name: [(path, ASCENDING)] + TS_ID_INDEX
+                  for name, path in LIST_FILTERS.items()}
+
 
 class RefTransform(SONManipulator):
 
@@ -51,6 +57,10 @@ class MongoEngine(object):
         self.options = dict(app['config']['database'])
         assert self.options.pop('engine', 'mongo') == 'mongo'
         self.db_name = self.options.pop('database', 'dozorro')
+        if 'pool_min' in self.options:
+            self.options['minPoolSize'] = int(self.options.pop('pool_min'))
+        if 'pool_max' in self.options:
+            self.options['maxPoolSize'] = int(self.options.pop('pool_max'))
         self.client = motor_asyncio.AsyncIOMotorClient(**self.options)
         self.db = self.client[self.db_name]
         self.son = RefTransform()
@@ -59,36 +69,38 @@ class MongoEngine(object):
     async def close(self):
         self.client.close()
 
-    def pack_offset(self, offset):
-        if offset is None:
-            return offset
-        return pack('d', offset).hex()
-
-    def unpack_offset(self, offset):
-        if not offset or len(offset) != 16:
-            raise ValueError('bad offset')
-        return unpack('d', bytes.fromhex(offset))[0]
-
-    async def get_list(self, offset=None, limit=100, reverse=False, table='data'):
+    async def get_list(self, offset=None, limit=100, reverse=False, table='data',
+                       filters=None):
+        op = '$lt' if reverse else '$gt'
+        cond = dict()
         if offset:
-            offset = self.unpack_offset(offset)
-            cond = {'ts': {'$lt': offset}} if reverse else {'ts': {'$gt': offset}}
-        else:
-            cond = None
+            ts, item_id = unpack_offset(offset)
+            cond = {'ts': {op: ts}}
+            if item_id:
+                cond = {'$or': [cond, {'ts': ts, '_id': {op: item_id}}]}
+        index = TS_ID_INDEX
+        flt = list_filter(filters)
+        if flt:
+            cond[LIST_FILTERS[flt[0]]] = flt[1]
+            index = FILTER_INDEXES[flt[0]]
+        # projection of index fields only, so page is served from index
         proj = {'_id': 1, 'ts': 1}
-        sort = ('ts', DESCENDING) if reverse else ('ts', ASCENDING)
-        cursor = self.db[table].find(cond, proj).sort(*sort)
+        order = DESCENDING if reverse else ASCENDING
+        cursor = (self.db[table].find(cond, proj)
+            .sort([('ts', order), ('_id', order)])
+            .hint(index)
+            .limit(limit))
         items_list = list()
-        first_ts = None
-        last_ts = None
+        first = None
+        last = None
         for doc in await cursor.to_list(length=limit):
-            last_ts = doc['ts']
-            if not first_ts:
-                first_ts = last_ts
+            last = (doc['ts'], doc['_id'])
+            if not first:
+                first = last
             items_list.append({'id': doc['_id']})
-        first_ts = self.pack_offset(first_ts)
-        last_ts = self.pack_offset(last_ts)
-        return (items_list, first_ts, last_ts)
+        first = pack_offset(*first) if first else None
+        last = pack_offset(*last) if last else None
+        return (items_list, first, last)
 
     async def get_item(self, item_id, table='data'):
         doc = await self.db[table].find_one({'_id': item_id})
@@ -117,11 +129,29 @@ class MongoEngine(object):
             items_list.append(doc)
         return items_list
 
+    async def changes(self, table='data'):
+        # change streams require replica set or sharded cluster
+        collection = self.db[table]
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        async with collection.watch(pipeline) as stream:
+            async for change in stream:
+                doc = change['fullDocument']
+                doc['id'] = doc.pop('_id')
+                doc.pop('ts', None)
+                if self.son.need_transform(doc, collection):
+                    self.son.transform_outgoing(doc, collection)
+                yield doc
+
     async def check_exists(self, item_id, table='data', model=None):
         count = await self.db[table].count_documents({'_id': item_id})
         assert count == 1, '{} not found in {}'.format(item_id, table)
         return True
 
+    async def check_exists_many(self, items_ids, table='data'):
+        cursor = self.db[table].find({'_id': {'$in': items_ids}}, {'_id': 1})
+        found = set([doc['_id'] async for doc in cursor])
+        return check_found(items_ids, found, table)
+
     async def put_item(self, data, table='data'):
         if self.son.need_transform(data, self.db[table]):
             self.son.transform_incoming(data, self.db[table])
@@ -138,6 +168,41 @@ class MongoEngine(object):
             raise RuntimeError('insert error') from e
         return True
 
+    async def put_many(self, items, table='data'):
+        ts = time()
+        for n, data in enumerate(items):
+            if self.son.need_transform(data, self.db[table]):
+                self.son.transform_incoming(data, self.db[table])
+            data['ts'] = ts + n * 1e-6
+            if '_id' not in data:
+                data['_id'] = data.pop('id')
+        result = ['created'] * len(items)
+        try:
+            await self.db[table].insert_many(items, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                n = error['index']
+                if error['code'] == 11000:
+                    result[n] = 'duplicate'
+                else:   # pragma: no cover
+                    logger.error('{} for {}'.format(error.get('errmsg'), items[n]['_id']))
+                    result[n] = 'error'
+        return result
+
+    async def get_stats(self, kind, key):
+        prefix = stats_id(kind, key)
+        cond = {'_id': {'$gte': prefix, '$lt': prefix + '\uffff'}}
+        rows = [(doc['_id'], doc['count']) async for doc in self.db['stats'].find(cond)]
+        return stats_models(prefix, rows)
+
+    async def update_stats(self, counts):
+        requests = [UpdateOne({'_id': counter_id}, {'$inc': {'count': count}}, upsert=True)
+                    for counter_id, count in counts.items()]
+        await self.db['stats'].bulk_write(requests, ordered=False)
+
+    async def clear_stats(self):
+        await self.db['stats'].delete_many({})
+
     async def init_tables(self, drop_database=False):
         if drop_database:
             await self.client.drop_database(self.db_name)
@@ -145,3 +210,21 @@ class MongoEngine(object):
         await self.db.create_collection('data')
         table = self.db['data']
         await table.create_index('ts')
+        await self.update_indexes()
+
+    async def update_tables(self):
+        # don't create collection implicitly before init_tables
+        if 'data' in await self.db.list_collection_names():
+            await self.update_indexes()
+
+    async def check_tables(self):
+        if 'data' not in await self.db.list_collection_names():
+            return []
+        indexes = await self.db['data'].index_information()
+        expected = ['ts_id'] + [name + '_ts_id' for name in FILTER_INDEXES]
+        return [name for name in expected if name not in indexes]
+
+    async def update_indexes(self, table='data'):
+        await self.db[table].create_index(TS_ID_INDEX, name='ts_id')
+        for name, index in FILTER_INDEXES.items():
+            await self.db[table].create_index(index, name=name + '_ts_id')
@@ -1,9 +1,12 @@
 import asyncio
 import logging
 from time import time
+from collections import deque
 from rethinkdb import r
-from rethinkdb.errors import ReqlDriverError, ReqlOpFailedError
-from struct import pack, unpack
+from rethinkdb.errors import ReqlOpFailedError
+from dozorro.api.backend import LIST_FILTERS, check_found, list_filter, pack_offset, stats_id, \
+    stats_models, unpack_offset
+from .pool import ConnectionPool
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +20,12 @@ class RethinkEngine(object):
             self.options['db'] = self.options.pop('database', 'dozorro')
         self.read_mode = self.options.pop('read_mode', 'single')
         keep_alive = self.options.pop('keep_alive', False)
-        self.conn = await r.connect(**self.options)
+        hosts = ConnectionPool.parse_hosts(self.options.pop('hosts', None))
+        min_size = self.options.pop('pool_min', 1)
+        max_size = self.options.pop('pool_max', 10)
+        retries = self.options.pop('connect_retries', 3)
+        self.pool = ConnectionPool(self.options, hosts, min_size, max_size, retries)
+        await self.pool.open()
         self.keep_alive_task = None
         if keep_alive:
             loop = asyncio.get_event_loop()
@@ -30,16 +38,10 @@ class RethinkEngine(object):
             self.keep_alive_task.cancel()
             await self.keep_alive_task
             self.keep_alive_task = None
-        if self.conn:
-            await self.conn.close()
-            self.conn = None
+        await self.pool.close()
 
     async def check_open(self):
-        try:
-            self.conn.check_open()
-        except (AttributeError, ReqlDriverError) as e:  # pragma: no cover
-            logger.error('Connection error: {}'.format(e))
-            self.conn = await r.connect(**self.options)
+        await self.pool.check()
 
     async def keep_alive(self, loop):
         while loop.is_running():
@@ -51,49 +53,46 @@ class RethinkEngine(object):
             except Exception:   # pragma: no cover
                 logger.exception('RethinkEngine.KeepAlive')
 
-    def pack_offset(self, offset):
-        if offset is None:
-            return offset
-        return pack('d', offset).hex()
-
-    def unpack_offset(self, offset):
-        if not offset or len(offset) != 16:
-            raise ValueError('bad offset')
-        return unpack('d', bytes.fromhex(offset))[0]
-
-    async def get_list(self, offset=None, limit=100, reverse=False, table='data'):
-        minval, maxval, oindex = r.minval, r.maxval, 'ts'
+    async def get_list(self, offset=None, limit=100, reverse=False, table='data',
+                       filters=None):
+        index, prefix = 'ts_id', []
+        flt = list_filter(filters)
+        if flt:
+            index, prefix = flt[0] + '_ts_id', [flt[1]]
+        minval, maxval = prefix + [r.minval], prefix + [r.maxval]
         if offset:
-            offset = self.unpack_offset(offset)
+            ts, item_id = unpack_offset(offset)
+            # old offsets have only ts, skip all items with that ts
             if reverse:
-                maxval = offset
+                maxval = prefix + [ts, item_id or r.minval]
             else:
-                minval = offset
-        if reverse:
-            oindex = r.desc(oindex)
-        cursor = await (r.table(table, read_mode=self.read_mode)
-            .between(minval, maxval, index='ts', left_bound='open')
-            .order_by(index=oindex)
-            .limit(limit)
-            .pluck('id', 'ts')
-            .run(self.conn))
+                minval = prefix + [ts, item_id or r.maxval]
+        oindex = r.desc(index) if reverse else index
         items_list = list()
-        first_ts = None
-        last_ts = None
-        # for doc in cursor:
-        while await cursor.fetch_next():
-            doc = await cursor.next()
-            last_ts = doc.pop('ts')
-            if not first_ts:
-                first_ts = last_ts
-            items_list.append(doc)
-        first_ts = self.pack_offset(first_ts)
-        last_ts = self.pack_offset(last_ts)
-        return (items_list, first_ts, last_ts)
+        first = None
+        last = None
+        async with self.pool.connection() as conn:
+            cursor = await (r.table(table, read_mode=self.read_mode)
+                .between(minval, maxval, index=index,
+                         left_bound='open', right_bound='open')
+                .order_by(index=oindex)
+                .limit(limit)
+                .pluck('id', 'ts')
+                .run(conn))
+            while await cursor.fetch_next():
+                doc = await cursor.next()
+                last = (doc.pop('ts'), doc['id'])
+                if not first:
+                    first = last
+                items_list.append(doc)
+        first = pack_offset(*first) if first else None
+        last = pack_offset(*last) if last else None
+        return (items_list, first, last)
 
     async def get_item(self, item_id, table='data'):
-        doc = await (r.table(table, read_mode=self.read_mode)
-            .get(item_id).run(self.conn))
+        async with self.pool.connection() as conn:
+            doc = await (r.table(table, read_mode=self.read_mode)
+                .get(item_id).run(conn))
         if doc:
             doc.pop('ts')
         return doc
@@ -102,25 +101,53 @@ class RethinkEngine(object):
         if len(items_list) == 1:
             doc = await self.get_item(items_list[0], table)
             return [doc, ] if doc else []
-        cursor = await (r.table(table, read_mode=self.read_mode)
-                .get_all(*items_list).run(self.conn))
         docs = list()
-        while await cursor.fetch_next():
-            doc = await cursor.next()
-            doc.pop('ts')
-            docs.append(doc)
+        async with self.pool.connection() as conn:
+            cursor = await (r.table(table, read_mode=self.read_mode)
+                    .get_all(*items_list).run(conn))
+            while await cursor.fetch_next():
+                doc = await cursor.next()
+                doc.pop('ts')
+                docs.append(doc)
         return docs
 
+    async def changes(self, table='data'):
+        # changefeed holds own connection, not one from the pool
+        conn = await self.pool.open_connection()
+        try:
+            cursor = await r.table(table).changes().run(conn)
+            while await cursor.fetch_next():
+                change = await cursor.next()
+                doc = change.get('new_val')
+                if doc and not change.get('old_val'):
+                    doc.pop('ts', None)
+                    yield doc
+        finally:
+            await conn.close()
+
     async def check_exists(self, item_id, table='data', model=None):
-        doc = await (r.table(table, read_mode=self.read_mode).get(item_id)
-                .run(self.conn))
+        async with self.pool.connection() as conn:
+            doc = await (r.table(table, read_mode=self.read_mode).get(item_id)
+                    .run(conn))
         assert doc is not None, '{} not found in {}'.format(item_id, table)
         # assert not model or model == doc['envelope']['model'], 'bad model ref'
         return True
 
+    async def check_exists_many(self, items_ids, table='data'):
+        found = set()
+        if items_ids:
+            async with self.pool.connection() as conn:
+                cursor = await (r.table(table, read_mode=self.read_mode)
+                        .get_all(*items_ids).pluck('id').run(conn))
+                while await cursor.fetch_next():
+                    doc = await cursor.next()
+                    found.add(doc['id'])
+        return check_found(items_ids, found, table)
+
     async def put_item(self, data, table='data'):
         data['ts'] = time()
-        status = await r.table(table).insert(data).run(self.conn)
+        async with self.pool.connection() as conn:
+            status = await r.table(table).insert(data).run(conn)
         if status['errors']:
             first_error = status.get('first_error', 'insert error')
             logger.error('{} status {}'.format(first_error, status))
@@ -129,12 +156,104 @@ class RethinkEngine(object):
             raise RuntimeError('insert error')  # pragma: no cover
         return True
 
+    async def put_many(self, items, table='data'):
+        ts = time()
+        for n, data in enumerate(items):
+            data['ts'] = ts + n * 1e-6
+        async with self.pool.connection() as conn:
+            status = await r.table(table).insert(items, return_changes='always').run(conn)
+        if not status['errors']:
+            return ['created'] * len(items)
+        logger.error('{} errors {}'.format(status.get('first_error'), status['errors']))
+        # match per document changes by id, ts of concurrent batches may collide
+        outcomes = dict()
+        for change in status['changes']:
+            error = change.get('error')
+            if not error:
+                outcome = 'created'
+            elif error.startswith('Duplicate primary key'):
+                outcome = 'duplicate'
+            else:   # pragma: no cover
+                outcome = 'error'
+            doc = change.get('new_val') or change.get('old_val')
+            outcomes.setdefault(doc['id'], deque()).append(outcome)
+        # same id may come twice in one batch
+        return [outcomes[data['id']].popleft() if outcomes.get(data['id']) else 'error'
+                for data in items]
+
+    async def get_stats(self, kind, key):
+        prefix = stats_id(kind, key)
+        rows = list()
+        async with self.pool.connection() as conn:
+            cursor = await (r.table('stats', read_mode=self.read_mode)
+                .between(prefix, prefix + '\uffff')
+                .run(conn))
+            while await cursor.fetch_next():
+                doc = await cursor.next()
+                rows.append((doc['id'], doc['count']))
+        return stats_models(prefix, rows)
+
+    async def update_stats(self, counts):
+        docs = [{'id': counter_id, 'count': count} for counter_id, count in counts.items()]
+        async with self.pool.connection() as conn:
+            await r.table('stats').insert(docs, conflict=lambda _, old, new: old.merge(
+                {'count': old['count'] + new['count']})).run(conn)
+
+    async def clear_stats(self):
+        async with self.pool.connection() as conn:
+            await r.table('stats').delete().run(conn)
+
     async def init_tables(self, drop_database=False):
-        if drop_database:
+        async with self.pool.connection() as conn:
+            if drop_database:
+                try:
+                    await r.db_drop(self.options['db']).run(conn)
+                except ReqlOpFailedError:   # pragma: no cover
+                    pass
+            await r.db_create(self.options['db']).run(conn)
+            await r.table_create('data').run(conn)
+            await r.table('data').index_create('ts').run(conn)
+        await self.update_tables()
+
+    async def update_tables(self):
+        async with self.pool.connection() as conn:
+            tables = await r.table_list().run(conn)
+            if 'data' not in tables:
+                return
+            if 'stats' not in tables:
+                logger.info('Create table stats')
+                await r.table_create('stats').run(conn)
+        await self.update_indexes()
+
+    async def check_tables(self):
+        async with self.pool.connection() as conn:
             try:
-                await r.db_drop(self.options['db']).run(self.conn)
-            except ReqlOpFailedError:   # pragma: no cover
-                pass
-        await r.db_create(self.options['db']).run(self.conn)
-        await r.table_create('data').run(self.conn)
-        await r.table('data').index_create('ts').run(self.conn)
+                tables = await r.table_list().run(conn)
+            except ReqlOpFailedError:
+                return []
+            if 'data' not in tables:
+                return []
+            missing = [] if 'stats' in tables else ['stats']
+            indexes = await r.table('data').index_list().run(conn)
+        missing.extend(name for name in self.index_fields() if name not in indexes)
+        return missing
+
+    @staticmethod
+    def index_fields():
+        indexes = {'ts_id': [r.row['ts'], r.row['id']]}
+        for name, path in LIST_FILTERS.items():
+            field = r.row
+            for key in path.split('.'):
+                field = field[key]
+            indexes[name + '_ts_id'] = [field, r.row['ts'], r.row['id']]
+        return indexes
+
+    async def update_indexes(self, table='data'):
+        async with self.pool.connection() as conn:
+            indexes = await r.table(table).index_list().run(conn)
+            for name, fields in self.index_fields().items():
+                if name in indexes:
+                    continue
+                logger.info('Create index {} on {}'.format(name, table))
+                await r.table(table).index_create(name, fields).run(conn)
+            await r.table(table).index_wait().run(conn)
@@ -1,6 +1,6 @@
 
 async def database_middleware(app, handler):
     async def middleware_handler(request):
-        await request.app['db'].check_open()
+        # connections are checked by pool on acquire
         return await handler(request)
     return middleware_handler
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from itertools import cycle
+from collections import deque
+from contextlib import asynccontextmanager
+from rethinkdb import r
+from rethinkdb.errors import ReqlDriverError
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Pool of rethinkdb connections to one or several cluster nodes
+
+    New connections go to nodes in round-robin order, unreachable node is
+    skipped and whole round is retried with exponential backoff.
+    """
+    def __init__(self, options, hosts=None, min_size=1, max_size=10,
+                 retries=3, retry_delay=0.5, max_delay=10):
+        self.options = options
+        self.hosts = hosts or [{}]
+        self.next_host = cycle(self.hosts)
+        self.min_size = int(min_size)
+        self.max_size = max(int(max_size), self.min_size, 1)
+        self.retries = max(int(retries), 1)
+        self.retry_delay = float(retry_delay)
+        self.max_delay = float(max_delay)
+        self.free = list()
+        # all open connections, both free and checked out
+        self.conns = set()
+        self.waiters = deque()
+        self.size = 0
+
+    @staticmethod
+    def parse_hosts(hosts):
+        result = list()
+        for host in hosts or []:
+            host, _, port = str(host).partition(':')
+            result.append({'host': host, 'port': int(port)} if port else {'host': host})
+        return result
+
+    async def open(self):
+        for _ in range(self.min_size):
+            self.size += 1
+            try:
+                self.free.append(await self.connect())
+            except Exception:
+                self.size -= 1
+                raise
+
+    async def close(self):
+        conns = list(self.conns)
+        self.free = list()
+        self.conns = set()
+        self.size = 0
+        for conn in conns:
+            await conn.close()
+
+    def drop(self, conn):
+        if conn in self.conns:
+            self.conns.remove(conn)
+            self.size -= 1
+
+    async def connect(self):
+        conn = await self.open_connection()
+        self.conns.add(conn)
+        return conn
+
+    async def open_connection(self):
+        """Connect to next reachable node, connection is not owned by pool"""
+        delay = self.retry_delay
+        last_exc = ReqlDriverError('No rethinkdb hosts to connect')
+        for attempt in range(self.retries):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+            for _ in range(len(self.hosts)):
+                options = dict(self.options, **next(self.next_host))
+                try:
+                    return await r.connect(**options)
+                except ReqlDriverError as e:
+                    logger.error('Connect to {} error: {}'.format(options.get('host'), e))
+                    last_exc = e
+        raise last_exc
+
+    async def acquire(self):
+        while True:
+            while self.free:
+                conn = self.free.pop()
+                if conn.is_open():
+                    return conn
+                self.drop(conn)
+            if self.size < self.max_size:
+                self.size += 1
+                try:
+                    return await self.connect()
+                except Exception:
+                    self.size -= 1
+                    raise
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def release(self, conn):
+        # connections released after close are already closed by it
+        if conn in self.conns:
+            if conn.is_open():
+                self.free.append(conn)
+            else:
+                self.drop(conn)
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    async def check(self):
+        for conn in list(self.free):
+            if not conn.is_open():
+                logger.error('Drop closed connection {}'.format(conn))
+                self.free.remove(conn)
+                self.drop(conn)
+        while self.size < self.min_size:
+            self.size += 1
+            try:
+                self.free.append(await self.connect())
+            except Exception:
+                self.size -= 1
+                raise
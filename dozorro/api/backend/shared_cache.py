@@ -0,0 +1,234 @@
+import os
+import mmap
+import fcntl
+import logging
+from hashlib import md5
+from struct import Struct
+from contextlib import contextmanager
+from rapidjson import loads
+from dozorro.api.backend import dump_item
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DZIC'
+VERSION = 1
+WAYS = 8
+
+# magic, version, buckets, ways, arena size, arena head
+HEADER = Struct('<4sIIIQQ')
+HEADER_SIZE = 64
+HEAD_OFFSET = 24
+HEAD = Struct('<Q')
+# bucket is seq followed by WAYS entries of key, position and length
+SEQ = Struct('<Q')
+ENTRY = Struct('<16sQI4x')
+BUCKET_SIZE = SEQ.size + WAYS * ENTRY.size
+# arena record is key and length followed by data, aligned to 8 bytes
+RECORD = Struct('<16sI4x')
+READ_RETRIES = 3
+
+
+class SharedItemCache(object):
+    """Item cache in mmap'ed file shared by all workers of the host
+
+    File holds set associative index and ring buffer arena of serialized
+    items. Writers append to the arena under fcntl lock and entries whose
+    data is overwritten by later records are evicted implicitly, so the
+    arena size is the memory budget. Readers don't lock, they check bucket
+    sequence number and the arena head after copying the data and treat
+    any concurrent change as a miss. Items never change, so there is no
+    invalidation. Put the file on tmpfs, e.g. /dev/shm.
+    """
+    def __init__(self, shared, max_items=100000, max_bytes=256 * 1024 * 1024):
+        self.path = shared
+        self.arena_size = int(max_bytes)
+        buckets = 1
+        while buckets * WAYS < int(max_items):
+            buckets *= 2
+        self.buckets = buckets
+        self.mask = buckets - 1
+        self.index_offset = HEADER_SIZE
+        self.arena_offset = HEADER_SIZE + buckets * BUCKET_SIZE
+        self.size = self.arena_offset + self.arena_size
+        self.max_record = self.arena_size // 4
+        self.hits = 0
+        self.misses = 0
+        self.fd = self.open_file()
+        self.mm = mmap.mmap(self.fd, self.size)
+
+    def header(self):
+        return (MAGIC, VERSION, self.buckets, WAYS, self.arena_size)
+
+    def open_file(self):
+        """Open cache file, replace it when it is new or has other parameters
+
+        File is replaced, not truncated, because old workers may still use
+        the mapping of it.
+        """
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            ready = False
+            try:
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue
+                header = os.pread(fd, HEADER.size, 0)
+                ready = os.fstat(fd).st_size == self.size and len(header) == HEADER.size \
+                    and HEADER.unpack(header)[:5] == self.header()
+                if ready:
+                    return fd
+                self.create_file()
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+                if not ready:
+                    os.close(fd)
+
+    def create_file(self):
+        logger.info('Create shared item cache {} size {}'.format(self.path, self.size))
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, HEADER.pack(*self.header(), 0), 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+            os.close(self.fd)
+
+    @contextmanager
+    def lock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+
+    @staticmethod
+    def item_key(item_id):
+        if len(item_id) == 32:
+            try:
+                return bytes.fromhex(item_id)
+            except ValueError:
+                pass
+        return md5(item_id.encode()).digest()
+
+    def bucket_offset(self, key):
+        return self.index_offset + (int.from_bytes(key[:8], 'little') & self.mask) * BUCKET_SIZE
+
+    def head(self):
+        return HEAD.unpack_from(self.mm, HEAD_OFFSET)[0]
+
+    def find_entry(self, key):
+        base = self.bucket_offset(key)
+        for _ in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self.mm, base)[0]
+            if seq & 1:
+                continue
+            found = None
+            for offset in range(base + SEQ.size, base + BUCKET_SIZE, ENTRY.size):
+                entry = ENTRY.unpack_from(self.mm, offset)
+                if entry[0] == key and entry[2]:
+                    found = entry[1:]
+                    break
+            if SEQ.unpack_from(self.mm, base)[0] == seq:
+                return found
+        return None
+
+    def is_valid(self, entry):
+        # data of entry is overwritten when head moved beyond it by arena size
+        return entry is not None and self.head() <= entry[0] + self.arena_size
+
+    def read(self, key):
+        entry = self.find_entry(key)
+        if not self.is_valid(entry):
+            return None
+        pos, length = entry
+        start = self.arena_offset + pos % self.arena_size
+        record = self.mm[start:start + RECORD.size + length]
+        # record might be overwritten while it was copied
+        if record[:16] != key or self.head() > pos + self.arena_size:
+            return None
+        return record[RECORD.size:]
+
+    def write(self, key, data):
+        length = len(data)
+        size = (RECORD.size + length + 7) & ~7
+        with self.lock():
+            pos = self.head()
+            if pos % self.arena_size + size > self.arena_size:
+                pos += self.arena_size - pos % self.arena_size
+            # move head first, readers of overwritten records see it
+            HEAD.pack_into(self.mm, HEAD_OFFSET, pos + size)
+            start = self.arena_offset + pos % self.arena_size
+            RECORD.pack_into(self.mm, start, key, length)
+            self.mm[start + RECORD.size:start + RECORD.size + length] = data
+            self.update_entry(key, pos, length, pos + size)
+
+    def update_entry(self, key, pos, length, head):
+        base = self.bucket_offset(key)
+        seq = SEQ.unpack_from(self.mm, base)[0] | 1
+        SEQ.pack_into(self.mm, base, seq)
+        victim = None
+        oldest = None
+        for offset in range(base + SEQ.size, base + BUCKET_SIZE, ENTRY.size):
+            entry_key, entry_pos, entry_length = ENTRY.unpack_from(self.mm, offset)
+            if entry_key == key or not entry_length or head > entry_pos + self.arena_size:
+                victim = offset
+                break
+            if oldest is None or entry_pos < oldest:
+                victim, oldest = offset, entry_pos
+        ENTRY.pack_into(self.mm, victim, key, pos, length)
+        SEQ.pack_into(self.mm, base, seq + 1)
+
+    def __len__(self):
+        count = 0
+        head = self.head()
+        for base in range(self.index_offset, self.arena_offset, BUCKET_SIZE):
+            for offset in range(base + SEQ.size, base + BUCKET_SIZE, ENTRY.size):
+                _, pos, length = ENTRY.unpack_from(self.mm, offset)
+                if length and head <= pos + self.arena_size:
+                    count += 1
+        return count
+
+    def __contains__(self, item_id):
+        return self.is_valid(self.find_entry(self.item_key(item_id)))
+
+    def get(self, item_id):
+        data = self.get_data(item_id)
+        if data is None:
+            return None
+        return loads(data)
+
+    def get_data(self, item_id):
+        data = self.read(self.item_key(item_id))
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, item_id, doc):
+        if item_id in self:
+            return
+        self.put_data(item_id, dump_item(doc))
+
+    def put_data(self, item_id, data):
+        if not data or RECORD.size + len(data) > self.max_record:
+            return
+        key = self.item_key(item_id)
+        # other worker may have stored it already
+        if self.is_valid(self.find_entry(key)):
+            return
+        self.write(key, data)
+
+    def stats(self):
+        return {
+            'bytes': min(self.head(), self.arena_size),
+            'hits': self.hits,
+            'misses': self.misses
+        }
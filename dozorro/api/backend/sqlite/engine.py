@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from time import time
+from rapidjson import loads
+from concurrent.futures import ThreadPoolExecutor
+from dozorro.api.backend import LIST_FILTERS, check_found, dump_item, list_filter, pack_offset, \
+    stats_id, stats_models, unpack_offset
+
+logger = logging.getLogger(__name__)
+
+TABLES = ('data',)
+
+# expression indexes, queries must use exactly the same expressions
+FILTER_EXPR = {name: "json_extract(CAST(doc AS TEXT), '$.{}')".format(path)
+               for name, path in LIST_FILTERS.items()}
+
+
+class SqliteEngine(object):
+    """Embedded engine on sqlite file in WAL mode
+
+    Rows are clustered by (ts, id) so list pages are range scans, documents
+    are stored serialized without ts. Queries run in reader threads, each
+    with own connection, all writes go through single writer thread.
+    """
+    async def init_engine(self, app):
+        self.options = dict(app['config']['database'])
+        assert self.options.pop('engine', 'sqlite') == 'sqlite'
+        self.path = self.options.pop('path', 'dozorro.db')
+        self.timeout = float(self.options.pop('timeout', 30))
+        self.synchronous = self.options.pop('synchronous', 'NORMAL')
+        self.mmap_size = int(self.options.pop('mmap_size', 0))
+        readers = int(self.options.pop('readers', 4))
+        self.changes_interval = float(self.options.pop('changes_interval', 1))
+        self.changes_overlap = float(self.options.pop('changes_overlap', 10))
+        self.local = threading.local()
+        self.conns = list()
+        self.conns_lock = threading.Lock()
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix='sqlite-reader')
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='sqlite-writer')
+        app['db'] = self
+
+    async def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
+        with self.conns_lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = list()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
+            if self.mmap_size:
+                conn.execute('PRAGMA mmap_size={}'.format(self.mmap_size))
+            with self.conns_lock:
+                self.conns.append(conn)
+            self.local.conn = conn
+        return conn
+
+    async def read(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.readers, func, *args)
+
+    async def write(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.writer, func, *args)
+
+    @staticmethod
+    def check_table(table):
+        if table not in TABLES:
+            raise ValueError('unknown table')
+        return table
+
+    def select_list(self, table, ts, item_id, limit, reverse, flt):
+        op = '<' if reverse else '>'
+        where = list()
+        args = list()
+        if flt:
+            where.append('{} = ?'.format(FILTER_EXPR[flt[0]]))
+            args.append(flt[1])
+        if item_id:
+            where.append('(ts, id) {} (?, ?)'.format(op))
+            args.extend((ts, item_id))
+        elif ts is not None:
+            where.append('ts {} ?'.format(op))
+            args.append(ts)
+        sql = 'SELECT id, ts FROM {}'.format(table)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ts DESC, id DESC LIMIT ?' if reverse else ' ORDER BY ts, id LIMIT ?'
+        args.append(limit)
+        return self.connect().execute(sql, args).fetchall()
+
+    async def get_list(self, offset=None, limit=100, reverse=False, table='data',
+                       filters=None):
+        ts, item_id = unpack_offset(offset) if offset else (None, None)
+        rows = await self.read(self.select_list, self.check_table(table),
+                               ts, item_id, limit, reverse, list_filter(filters))
+        items_list = [{'id': row[0]} for row in rows]
+        first = pack_offset(rows[0][1], rows[0][0]) if rows else None
+        last = pack_offset(rows[-1][1], rows[-1][0]) if rows else None
+        return (items_list, first, last)
+
+    def select_many(self, table, items_list):
+        sql = 'SELECT id, doc FROM {} WHERE id IN ({})'.format(
+            table, ','.join('?' * len(items_list)))
+        return dict(self.connect().execute(sql, items_list).fetchall())
+
+    async def get_many_raw(self, items_list, table='data'):
+        found = await self.read(self.select_many, self.check_table(table), items_list)
+        return [found[i] for i in items_list if i in found]
+
+    async def get_item(self, item_id, table='data'):
+        docs = await self.get_many_raw([item_id], table)
+        return loads(docs[0]) if docs else None
+
+    async def get_many(self, items_list, table='data'):
+        return [loads(data) for data in await self.get_many_raw(items_list, table)]
+
+    def select_since(self, table, ts, item_id):
+        sql = 'SELECT ts, id FROM {} WHERE (ts, id) > (?, ?) ORDER BY ts, id LIMIT 1000'.format(table)
+        return self.connect().execute(sql, (ts, item_id)).fetchall()
+
+    async def changes(self, table='data'):
+        """No native feed, poll ts index once per changes_interval
+
+        Rows committed by other processes may come with older ts, so each
+        poll scans again last changes_overlap seconds and skips ids already
+        sent. Rows committed later than that after their ts are not sent.
+        """
+        table = self.check_table(table)
+        last_ts = time()
+        sent = dict()
+        while True:
+            ts, item_id = last_ts - self.changes_overlap, ''
+            while True:
+                rows = await self.read(self.select_since, table, ts, item_id)
+                new_ids = [row[1] for row in rows if row[1] not in sent]
+                for data in await self.get_many(new_ids, table) if new_ids else []:
+                    yield data
+                for ts, item_id in rows:
+                    sent.setdefault(item_id, ts)
+                    last_ts = max(last_ts, ts)
+                if len(rows) < 1000:
+                    break
+            min_ts = last_ts - self.changes_overlap
+            sent = {k: v for k, v in sent.items() if v >= min_ts}
+            await asyncio.sleep(self.changes_interval)
+
+    def select_exists(self, table, item_id):
+        sql = 'SELECT 1 FROM {} WHERE id = ?'.format(table)
+        return self.connect().execute(sql, (item_id,)).fetchone()
+
+    async def check_exists(self, item_id, table='data', model=None):
+        row = await self.read(self.select_exists, self.check_table(table), item_id)
+        assert row is not None, '{} not found in {}'.format(item_id, table)
+        return True
+
+    def select_ids(self, table, items_ids):
+        sql = 'SELECT id FROM {} WHERE id IN ({})'.format(table, ','.join('?' * len(items_ids)))
+        return set(row[0] for row in self.connect().execute(sql, items_ids))
+
+    async def check_exists_many(self, items_ids, table='data'):
+        found = set()
+        if items_ids:
+            found = await self.read(self.select_ids, self.check_table(table), items_ids)
+        return check_found(items_ids, found, table)
+
+    def insert(self, table, rows):
+        conn = self.connect()
+        sql = 'INSERT OR IGNORE INTO {} (ts, id, doc) VALUES (?, ?, ?)'.format(table)
+        result = list()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for row in rows:
+                cursor = conn.execute(sql, row)
+                result.append('created' if cursor.rowcount == 1 else 'duplicate')
+        return result
+
+    async def put_item(self, data, table='data'):
+        row = (time(), data['id'], dump_item(data))
+        data['ts'] = row[0]
+        result = await self.write(self.insert, self.check_table(table), [row])
+        if result[0] != 'created':
+            logger.error('Duplicate id {}'.format(data['id']))
+            raise ValueError('{} already exists'.format(data['id']))
+        return True
+
+    async def put_many(self, items, table='data'):
+        ts = time()
+        rows = list()
+        for n, data in enumerate(items):
+            rows.append((ts + n * 1e-6, data['id'], dump_item(data)))
+            data['ts'] = rows[-1][0]
+        return await self.write(self.insert, self.check_table(table), rows)
+
+    def select_stats(self, prefix):
+        sql = 'SELECT id, count FROM stats WHERE id >= ? AND id < ?'
+        return self.connect().execute(sql, (prefix, prefix + '\uffff')).fetchall()
+
+    async def get_stats(self, kind, key):
+        prefix = stats_id(kind, key)
+        return stats_models(prefix, await self.read(self.select_stats, prefix))
+
+    def increment(self, counts):
+        conn = self.connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO stats (id, count) VALUES (?, 0)',
+                             [(counter_id,) for counter_id in counts])
+            conn.executemany('UPDATE stats SET count = count + ? WHERE id = ?',
+                             [(count, counter_id) for counter_id, count in counts.items()])
+
+    async def update_stats(self, counts):
+        await self.write(self.increment, counts)
+
+    def delete_stats(self):
+        self.connect().execute('DELETE FROM stats')
+
+    async def clear_stats(self):
+        await self.write(self.delete_stats)
+
+    def create_tables(self, drop_database):
+        conn = self.connect()
+        for table in TABLES:
+            if drop_database:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+            conn.execute('CREATE TABLE {} (ts REAL NOT NULL, id TEXT NOT NULL, '
+                         'doc BLOB NOT NULL, PRIMARY KEY (ts, id)) WITHOUT ROWID'.format(table))
+            conn.execute('CREATE UNIQUE INDEX {0}_id ON {0} (id)'.format(table))
+        if drop_database:
+            conn.execute('DROP TABLE IF EXISTS stats')
+        self.create_stats_table()
+        self.create_indexes()
+
+    def create_stats_table(self):
+        self.connect().execute('CREATE TABLE IF NOT EXISTS stats (id TEXT PRIMARY KEY, '
+                               'count INTEGER NOT NULL) WITHOUT ROWID')
+
+    def create_indexes(self):
+        conn = self.connect()
+        for table in TABLES:
+            for name, expr in FILTER_EXPR.items():
+                conn.execute('CREATE INDEX IF NOT EXISTS {0}_{1}_ts_id ON {0} ({2}, ts, id)'
+                             .format(table, name, expr))
+
+    async def init_tables(self, drop_database=False):
+        await self.write(self.create_tables, drop_database)
+
+    def table_exists(self, table):
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return self.connect().execute(sql, (table,)).fetchone() is not None
+
+    async def update_tables(self):
+        if await self.read(self.table_exists, 'data'):
+            await self.write(self.create_stats_table)
+            await self.write(self.create_indexes)
+
+    def select_missing(self):
+        sql = "SELECT name FROM sqlite_master WHERE type IN ('table', 'index')"
+        names = set(row[0] for row in self.connect().execute(sql))
+        if 'data' not in names:
+            return []
+        expected = ['stats'] + ['{}_{}_ts_id'.format(table, name)
+                                for table in TABLES for name in FILTER_EXPR]
+        return [name for name in expected if name not in names]
+
+    async def check_tables(self):
+        return await self.read(self.select_missing)
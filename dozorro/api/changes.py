@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import deque
+from rapidjson import dumps
+from dozorro.api.backend import dump_item
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber(object):
+    """Bounded buffer of encoded events for one client
+
+    Client which can't keep up is marked as overflow and disconnected,
+    it should reconnect and catch up by list_view.
+    """
+    def __init__(self, docs=False, max_size=1000):
+        self.docs = docs
+        self.max_size = max_size
+        self.items = deque()
+        self.event = asyncio.Event()
+        self.overflow = False
+        self.closed = False
+
+    def push(self, data):
+        if len(self.items) >= self.max_size:
+            self.overflow = True
+            self.items.clear()
+        else:
+            self.items.append(data)
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    async def get(self):
+        while not self.items and not self.overflow and not self.closed:
+            self.event.clear()
+            await self.event.wait()
+        if self.items:
+            return self.items.popleft()
+        return None
+
+
+class ChangesHub(object):
+    """Single upstream changes feed of this worker shared by all subscribers
+
+    Feed is started by first subscriber and stopped after the last one,
+    events are encoded once and pushed to every subscriber buffer.
+    """
+    def __init__(self, db, queue_size=1000, max_subscribers=1000, heartbeat=15,
+                 retry_delay=1, max_delay=30):
+        self.db = db
+        self.heartbeat = float(heartbeat)
+        self.queue_size = int(queue_size)
+        self.max_subscribers = int(max_subscribers)
+        self.retry_delay = float(retry_delay)
+        self.max_delay = float(max_delay)
+        self.subscribers = set()
+        self.docs_count = 0
+        self.feed_task = None
+        self.published = 0
+
+    def subscribe(self, docs=False):
+        if len(self.subscribers) >= self.max_subscribers:
+            raise OverflowError('too many subscribers')
+        sub = Subscriber(docs, self.queue_size)
+        self.subscribers.add(sub)
+        if docs:
+            self.docs_count += 1
+        if not self.feed_task:
+            self.feed_task = asyncio.ensure_future(self.follow())
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub not in self.subscribers:
+            return
+        self.subscribers.remove(sub)
+        if sub.docs:
+            self.docs_count -= 1
+        if not self.subscribers and self.feed_task:
+            self.feed_task.cancel()
+            self.feed_task = None
+
+    async def close(self):
+        for sub in list(self.subscribers):
+            sub.close()
+            self.unsubscribe(sub)
+        if self.feed_task:
+            self.feed_task.cancel()
+            await asyncio.gather(self.feed_task, return_exceptions=True)
+            self.feed_task = None
+
+    @staticmethod
+    def encode(item_id, data):
+        return b'id: ' + item_id.encode() + b'\ndata: ' + data + b'\n\n'
+
+    def publish(self, doc):
+        item_id = doc['id']
+        id_event = self.encode(item_id, dumps({'id': item_id}).encode())
+        doc_event = self.encode(item_id, dump_item(doc)) if self.docs_count else None
+        for sub in list(self.subscribers):
+            sub.push(doc_event if sub.docs else id_event)
+            if sub.overflow:
+                logger.warning('Changes subscriber overflow, disconnect')
+                self.unsubscribe(sub)
+        self.published += 1
+
+    async def follow(self):
+        delay = self.retry_delay
+        while True:
+            try:
+                async for doc in self.db.changes():
+                    self.publish(doc)
+                    delay = self.retry_delay
+            except asyncio.CancelledError:
+                break
+            except Exception:   # pragma: no cover
+                logger.exception('ChangesHub.Follow')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published
+        }
+
+
+def init_changes(app):
+    options = app['config']['changes']
+    if not isinstance(options, dict):
+        options = {}
+    app['changes'] = ChangesHub(app['db'], **options)
+    return app['changes']
@@ -0,0 +1,160 @@
+import zlib
+import asyncio
+import logging
+from aiohttp.web import Response
+from dozorro.api.backend import ItemCache
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_TYPES = ('application/json', 'application/x-ndjson')
+
+LEVELS = {'gzip': 6, 'br': 5, 'zstd': 3}
+
+
+def gzip_codec(level):
+    def compress(data):
+        obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return obj.compress(data) + obj.flush()
+    return compress
+
+
+def brotli_codec(level):
+    import brotli
+
+    def compress(data):
+        return brotli.compress(data, quality=level)
+    return compress
+
+
+def zstd_codec(level):
+    import zstandard
+
+    def compress(data):
+        # compressor objects are not thread safe, create one per call
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return compress
+
+
+CODECS = {
+    'gzip': gzip_codec,
+    'br': brotli_codec,
+    'zstd': zstd_codec,
+}
+
+
+def accepted_encodings(header):
+    """Return set of encodings from Accept-Encoding with q > 0"""
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name)
+    return accepted
+
+
+def variant_etag(etag, encoding):
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+def etag_base(tag):
+    """Strip encoding suffix from ETag of compressed variant"""
+    if tag.endswith('"'):
+        base, sep, encoding = tag[:-1].rpartition('-')
+        if sep and encoding in CODECS:
+            return base + '"'
+    return tag
+
+
+class Compressor(object):
+    """Negotiated compression of JSON responses
+
+    Encodings are tried in configured order, unavailable ones are skipped.
+    Responses of item_view with ETag never change, so their compressed
+    bodies are kept in LRU cache by ETag and encoding.
+    """
+    def __init__(self, encodings=('br', 'zstd', 'gzip'), levels=None, min_size=1024,
+                 cache_items=10000, cache_bytes=64 * 1024 * 1024, executor_size=256 * 1024):
+        levels = dict(LEVELS, **(levels or {}))
+        self.codecs = list()
+        for name in encodings:
+            if name not in CODECS:
+                raise ValueError('Unknown encoding: %s' % name)
+            try:
+                self.codecs.append((name, CODECS[name](int(levels[name]))))
+            except ImportError:
+                logger.warning('{} compression not available'.format(name))
+        self.min_size = int(min_size)
+        self.executor_size = int(executor_size)
+        self.cache = ItemCache(cache_items, cache_bytes) if cache_items else None
+        self.compressed = 0
+
+    def choose(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for name, codec in self.codecs:
+            if name in accepted or '*' in accepted:
+                return name, codec
+        return None, None
+
+    async def compress(self, codec, body):
+        self.compressed += 1
+        if len(body) < self.executor_size:
+            return codec(body)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, codec, body)
+
+    async def process(self, request, response):
+        if type(response) is not Response or response.status != 200:
+            return response
+        body = response.body
+        if not isinstance(body, bytes) or len(body) < self.min_size:
+            return response
+        if response.content_type not in COMPRESS_TYPES or 'Content-Encoding' in response.headers:
+            return response
+        response.headers.add('Vary', 'Accept-Encoding')
+        encoding, codec = self.choose(request.headers.get('Accept-Encoding', ''))
+        if not encoding:
+            return response
+
+        etag = response.headers.get('ETag')
+        cacheable = self.cache is not None and etag and \
+            request.match_info.route.name == 'item_view'
+        data = self.cache.get_data(etag + encoding) if cacheable else None
+        if data is None:
+            data = await self.compress(codec, body)
+            if cacheable:
+                self.cache.put_data(etag + encoding, data)
+
+        response.body = data
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.headers['ETag'] = variant_etag(etag, encoding)
+        return response
+
+    def stats(self):
+        stats = {'compressed': self.compressed}
+        if self.cache is not None:
+            stats.update(('cache_' + k, v) for k, v in self.cache.stats().items())
+        return stats
+
+
+def init_compress(app):
+    options = app['config']['compress']
+    if not isinstance(options, dict):
+        options = {}
+    app['compress'] = Compressor(**options)
+    return app['compress']
+
+
+async def compress_middleware(app, handler):
+    async def middleware_handler(request):
+        response = await handler(request)
+        return await app['compress'].process(request, response)
+    return middleware_handler
@@ -1,10 +1,17 @@
+import os
+import asyncio
 import argparse
 import rapidjson as json
-from iso8601 import parse_date
+from time import monotonic
+from collections import deque
 from aiohttp import ClientSession
 from asyncio import get_event_loop, sleep
+from concurrent.futures import ProcessPoolExecutor
 from dozorro.api import backend, utils, validate
 
+# keyring and schemas of process pool worker, see init_worker
+worker_state = dict()
+
 
 async def init_tables(loop, config, root_key, dropdb=False):
     app = dict()
@@ -40,13 +47,7 @@ async def put_data(signed_json, api_url):
 
 
 def update_keyring(data, keyring):
-    payload = data['envelope']['payload'].copy()
-    payload['validSince'] = parse_date(payload['validSince'])
-    payload['validTill'] = parse_date(payload['validTill'])
-    owner = payload['owner']
-    if owner not in keyring:
-        keyring[owner] = []
-    keyring[owner].append(payload)
+    keyring.add(data['envelope']['payload'])
 
 
 def update_schemas(data, app):
@@ -60,6 +61,8 @@ def update_schemas(data, app):
         data['definitions'] = app['definitions']
 
     assert schema not in app['schemas']
+    schema_backend = app.get('config', {}).get('schema_backend')
+    app['validators'][schema] = validate.compile_schema(data, schema_backend)
     app['schemas'][schema] = data
 
 
@@ -80,97 +83,297 @@ async def validate_data(data, app):
     await validate.validate_schema(data['envelope'], app, check_refs=False)
 
 
-async def verify_database(config, api_url, ignore_errors=False):
-    app = {
-        'keyring': {},
+def new_verify_app(config=None):
+    return {
+        'config': config or {},
+        'keyring': validate.Keyring(),
         'schemas': {},
+        'validators': {},
         'definitions': {}
     }
-    app['config'] = utils.load_config(config)
-    await backend.init_engine(app)
-    success = 0
-    errors = 0
-    offset = None
+
+
+def error_text(e):
+    return '{}: {}'.format(e.__class__.__name__, e)
+
+
+def init_worker(config, admin_docs):
+    worker_state['loop'] = asyncio.new_event_loop()
+    worker_state['app'] = new_verify_app(config)
+    for data in admin_docs:
+        worker_state['loop'].run_until_complete(validate_data(data, worker_state['app']))
+
+
+def verify_items(items):
+    loop, app = worker_state['loop'], worker_state['app']
+    result = list()
+    for data in items:
+        try:
+            loop.run_until_complete(validate_data(data, app))
+            result.append(None)
+        except Exception as e:
+            result.append(error_text(e))
+    return result
+
+
+class Verifier(object):
+    """Verify pages of items in page order, form items in process pool
+
+    Admin items change keyring and schemas, so they are verified in main
+    process and the pool is restarted with new state before next form item.
+    """
+    def __init__(self, config=None, workers=1, checkpoint=None, ignore_errors=False,
+                 chunk_size=25):
+        self.app = new_verify_app(config)
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.ignore_errors = ignore_errors
+        self.chunk_size = chunk_size
+        self.admin_docs = list()
+        # admin items of completed pages, only they go to checkpoint
+        self.admin_done = 0
+        self.pool = None
+        self.pool_state = None
+        self.success = 0
+        self.errors = 0
+        self.offset = None
+        self.started = monotonic()
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return []
+        with open(self.checkpoint) as fp:
+            state = json.loads(fp.read())
+        self.offset = state['offset']
+        self.success = state['success']
+        self.errors = state['errors']
+        return state['admin']
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        state = {
+            'offset': self.offset,
+            'success': self.success,
+            'errors': self.errors,
+            'admin': [data['id'] for data in self.admin_docs[:self.admin_done]]
+        }
+        with open(self.checkpoint + '.tmp', 'w') as fp:
+            fp.write(json.dumps(state))
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    async def restore(self, get_many, admin_ids):
+        for n in range(0, len(admin_ids), 100):
+            docs = {data['id']: data for data in await get_many(admin_ids[n:n + 100])}
+            for item_id in admin_ids[n:n + 100]:
+                await self.verify_admin(docs[item_id])
+        self.admin_done = len(self.admin_docs)
+
+    async def verify_admin(self, data):
+        copy = json.loads(json.dumps(data))
+        try:
+            await validate_data(data, self.app)
+        except Exception as e:
+            return error_text(e)
+        # pool workers replay only admin items which passed
+        self.admin_docs.append(copy)
+        return None
+
+    def get_pool(self):
+        if self.pool_state != len(self.admin_docs):
+            if self.pool:
+                self.pool.shutdown(wait=False)
+            self.pool = ProcessPoolExecutor(self.workers, initializer=init_worker,
+                initargs=(self.app['config'], self.admin_docs))
+            self.pool_state = len(self.admin_docs)
+        return self.pool
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+    async def verify_forms(self, forms):
+        if self.workers > 1:
+            loop = get_event_loop()
+            return loop.run_in_executor(self.get_pool(), verify_items, forms)
+        result = list()
+        for data in forms:
+            try:
+                await validate_data(data, self.app)
+                result.append(None)
+            except Exception as e:
+                result.append(error_text(e))
+        return result
+
+    async def submit(self, items):
+        chunks = list()
+        forms = list()
+        for data in items + [None]:
+            is_form = data is not None and not data['envelope']['model'].startswith('admin/')
+            if is_form:
+                forms.append(data)
+            if forms and (not is_form or len(forms) >= self.chunk_size):
+                chunks.append((forms, await self.verify_forms(forms)))
+                forms = list()
+            if data is not None and not is_form:
+                chunks.append(([data], [await self.verify_admin(data)]))
+        return chunks
+
+    async def complete(self, chunks, offset, admin_done):
+        for items, result in chunks:
+            if not isinstance(result, list):
+                result = await result
+            for data, error in zip(items, result):
+                env = data['envelope']
+                if not error:
+                    self.success += 1
+                    print("OK", self.success, data['id'], env['date'], env['owner'], env['model'])
+                    continue
+                self.errors += 1
+                print("\033[91m" + "FAIL", self.errors, data['id'], env['date'], env['owner'],
+                      env['model'], "\033[0m " + "ERROR:", error)
+                if not self.ignore_errors:
+                    raise validate.ValidateError(error)
+        self.offset = offset
+        self.admin_done = admin_done
+        self.save_checkpoint()
+
+    async def produce(self, pages, queue):
+        try:
+            async for page in pages:
+                await queue.put(page)
+        except Exception as e:
+            # passed to run, otherwise it waits for the next page forever
+            await queue.put(e)
+            return
+        await queue.put(None)
+
+    async def run(self, pages):
+        queue = asyncio.Queue(maxsize=max(2, self.workers))
+        producer = asyncio.ensure_future(self.produce(pages, queue))
+        pending = deque()
+        resumed = self.success + self.errors
+        try:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                items, offset = page
+                pending.append((await self.submit(items), offset, len(self.admin_docs)))
+                while len(pending) > self.workers:
+                    await self.complete(*pending.popleft())
+            while pending:
+                await self.complete(*pending.popleft())
+        finally:
+            producer.cancel()
+            self.close()
+        elapsed = monotonic() - self.started
+        print("SUCCESS", self.success, "ERRORS", self.errors)
+        verified = self.success + self.errors - resumed
+        print("TIME {:.1f}s RATE {:.1f} items/s".format(elapsed, verified / max(elapsed, 1e-6)))
+
+
+async def database_pages(db, offset):
     while True:
-        page, _, offset = await app['db'].get_list(offset)
+        page, _, offset = await db.get_list(offset)
         if not page:
             break
         pids = [p['id'] for p in page]
-        items = await app['db'].get_many(pids)
-        assert len(pids) == len(items)
-        for pid in pids:
-            for data in items:
-                if pid == data['id']:
-                    break
-            env = data['envelope']
-            try:
-                await validate_data(data, app)
-                success += 1
-                print("OK", success, data['id'], env['date'], env['owner'], env['model'])
-            except Exception as e:  # pragma: no cover
-                errors += 1
-                print("\033[91m" + "FAIL", errors, data['id'], env['date'], env['owner'], env['model'],
-                      "\033[0m " + "ERROR:", e)
-                if not ignore_errors:
-                    await app['db'].close()
-                    raise
+        docs = {data['id']: data for data in await db.get_many(pids)}
+        assert len(pids) == len(docs)
+        yield [docs[pid] for pid in pids], offset
         if not offset:
             break
-    print("SUCCESS", success, "ERRORS", errors)
-    await app['db'].close()
 
 
-async def verify_api_data(api_url, ignore_errors=False, pause=0.1):
-    if ':' not in api_url:
-        api_url += ':8400'  # pragma: no cover
-    if '/api/' not in api_url:
-        api_url += '/api/v1/data'
-    if '://' not in api_url:
-        api_url = 'http://' + api_url
-    app = {
-        'keyring': {},
-        'schemas': {},
-        'definitions': {}
-    }
-    session = ClientSession()
-    success = 0
-    errors = 0
-    offset = ''
+async def rebuild_stats(config):
+    """Count all items and replace stats table
+
+    Counters are written after the full scan, items stored by running
+    API during the scan may be counted twice or missed.
+    """
+    app = {'config': utils.load_config(config)}
+    await backend.init_engine(app)
+    db = app['db']
+    counts = dict()
+    total = 0
+    try:
+        async for items, _ in database_pages(db, None):
+            backend.count_stats(items, counts)
+            total += len(items)
+        await db.clear_stats()
+        counters = list(counts.items())
+        for n in range(0, len(counters), 1000):
+            await db.update_stats(dict(counters[n:n + 1000]))
+    finally:
+        await db.close()
+    utils.logger.info("Stats rebuilt, {} items {} counters".format(total, len(counts)))
+
+
+async def api_pages(session, api_url, offset, pause=0.1):
     while True:
-        list_url = api_url + '?offset=' + offset
+        list_url = api_url + '?offset=' + (offset or '')
         resp = await session.get(list_url)
         resp.raise_for_status()
         page = await resp.json()
         if not page['data']:
             break
-        items_ids = ','.join([p['id'] for p in page['data']])
-        items_url = api_url + '/' + items_ids
+        pids = [p['id'] for p in page['data']]
         await sleep(pause)
-        resp = await session.get(items_url)
-        resp.raise_for_status()
-        resp_data = await resp.json()
-        assert len(page['data']) == len(resp_data['data'])
-        for row in page['data']:
-            for data in resp_data['data']:
-                if data['id'] == row['id']:
-                    break
-            env = data['envelope']
-            try:
-                await validate_data(data, app)
-                success += 1
-                print("OK", success, data['id'], env['date'], env['owner'], env['model'])
-            except Exception as e:  # pragma: no cover
-                errors += 1
-                print("\033[91m" + "FAIL", errors, data['id'], env['date'], env['owner'], env['model'],
-                      "\033[0m " + "ERROR:", e)
-                if not ignore_errors:
-                    await session.close()
-                    raise
+        docs = {data['id']: data for data in await api_get_many(session, api_url, pids)}
+        assert len(pids) == len(docs)
         offset = page.get('next_page', {}).get('offset')
+        yield [docs[pid] for pid in pids], offset
         if not offset:
             break
-    print("SUCCESS", success, "ERRORS", errors)
-    await session.close()
+
+
+async def api_get_many(session, api_url, items_ids):
+    resp = await session.get(api_url + '/' + ','.join(items_ids))
+    resp.raise_for_status()
+    resp_data = await resp.json()
+    return resp_data['data']
+
+
+async def verify_database(config, ignore_errors=False, workers=1, checkpoint=None):
+    app = {'config': utils.load_config(config)}
+    await backend.init_engine(app)
+    verifier = Verifier(app['config'], workers, checkpoint, ignore_errors)
+    try:
+        await verifier.restore(app['db'].get_many, verifier.load_checkpoint())
+        await verifier.run(database_pages(app['db'], verifier.offset))
+    finally:
+        await app['db'].close()
+
+
+async def verify_api_data(api_url, ignore_errors=False, pause=0.1, workers=1, checkpoint=None):
+    if ':' not in api_url:
+        api_url += ':8400'  # pragma: no cover
+    if '/api/' not in api_url:
+        api_url += '/api/v1/data'
+    if '://' not in api_url:
+        api_url = 'http://' + api_url
+    session = ClientSession()
+    verifier = Verifier(None, workers, checkpoint, ignore_errors)
+    try:
+        admin_ids = verifier.load_checkpoint()
+        await verifier.restore(lambda ids: api_get_many(session, api_url, ids), admin_ids)
+        await verifier.run(api_pages(session, api_url, verifier.offset, pause))
+    finally:
+        await session.close()
+
+
+async def migrate_tables(config):
+    """Create tables, indexes and views added since database was created"""
+    app = {'config': utils.load_config(config)}
+    await backend.init_engine(app)
+    try:
+        await app['db'].update_tables()
+    finally:
+        await app['db'].close()
 
 
 def cdb_init():
@@ -194,15 +397,36 @@ def cdb_put():
     loop.run_until_complete(put_data(args.signed_json, args.api_url))
 
 
+def cdb_migrate():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    args = parser.parse_args()
+    loop = get_event_loop()
+    loop.run_until_complete(migrate_tables(args.config))
+    utils.logger.info("Tables updated")
+
+
+def cdb_stats():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    args = parser.parse_args()
+    loop = get_event_loop()
+    loop.run_until_complete(rebuild_stats(args.config))
+
+
 def cdb_verify():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config')
     parser.add_argument('--ignore', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--checkpoint')
     parser.add_argument('api_url', nargs='?', default='127.0.0.1:8400')
     args = parser.parse_args()
     loop = get_event_loop()
     if args.config:
-        coro = verify_database(args.config, args.ignore)
+        coro = verify_database(args.config, args.ignore,
+            workers=args.workers, checkpoint=args.checkpoint)
     else:
-        coro = verify_api_data(args.api_url, args.ignore)
+        coro = verify_api_data(args.api_url, args.ignore,
+            workers=args.workers, checkpoint=args.checkpoint)
     loop.run_until_complete(coro)
@@ -2,12 +2,21 @@ import os
 import argparse
 from aiohttp import web
 from asyncio import get_event_loop
-from dozorro.api import backend, middleware, utils, views
+from dozorro.api import backend, changes, compress, metrics, middleware, mirror, reload, utils, \
+    validate, views
 
 
 async def shutdown_app(app):
+    if 'admin_watcher' in app:
+        await app['admin_watcher'].close()
+    if 'changes' in app:
+        await app['changes'].close()
+    if 'validate_executor' in app:
+        app['validate_executor'].close()
     if 'db' in app:
         await app['db'].close()
+    if 'mirror' in app:
+        await app['mirror'].close()
     if 'tenders' in app:
         await app['tenders'].close()
     if 'archive' in app:
@@ -23,18 +32,36 @@ async def init_app(config=None):
         config = utils.load_config(config)
     backend_middleware = backend.get_middleware(config)
     middlewares = [middleware.error_middleware]
+    if config.get('compress'):
+        middlewares.insert(0, compress.compress_middleware)
+    if config.get('metrics', True):
+        middlewares.insert(0, metrics.metrics_middleware)
     if backend_middleware:
         middlewares.append(backend_middleware)
     app = web.Application(middlewares=middlewares)
     app['config'] = config
+    if config.get('compress'):
+        compress.init_compress(app)
     await backend.init_engine(app)
     app.on_shutdown.append(shutdown_app)
+    if app['config'].get('changes'):
+        changes.init_changes(app)
     if not app['config'].get('readonly'):
         loop = get_event_loop()
         await utils.create_client(app, loop)
-        await utils.load_keyring(app)
-        await utils.load_schemas(app)
+        if app['config'].get('tenders', {}).get('mirror'):
+            await mirror.init_mirror(app, loop)
+        await utils.load_keyring_schemas(app)
+        if app['config'].get('reload'):
+            await reload.init_watcher(app)
+        if app['config'].get('validate_executor'):
+            options = app['config']['validate_executor']
+            app['validate_executor'] = validate.ValidateExecutor(**options)
+            # create pool before server starts serving
+            app['validate_executor'].get_pool(app)
     views.setup_routes(app)
+    if app['config'].get('metrics', True):
+        metrics.setup_metrics(app)
     return app
 
 
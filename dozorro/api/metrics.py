@@ -0,0 +1,193 @@
+from time import perf_counter
+from bisect import bisect_left
+from aiohttp.web import Response
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# long lived streams would only skew request histogram
+SKIP_ROUTES = ('metrics_view', 'changes_view')
+
+HELP = {
+    'dozorro_request_seconds': 'Request handling time by route',
+    'dozorro_put_stage_seconds': 'Item PUT time by validation stage',
+    'dozorro_engine_seconds': 'Database engine call time by method',
+    'dozorro_tenders_seconds': 'Tenders API get_tender call time',
+    'dozorro_tenders_requests_total': 'Tenders API get_tender calls',
+    'dozorro_tenders_retries_total': 'Tenders API get_tender retries',
+    'dozorro_tenders_fallbacks_total': 'Tenders API fallbacks to archive',
+}
+
+
+class Histogram(object):
+    """Cumulative on render, so observe is one bisect and two additions"""
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Registry(object):
+    """Metrics of this worker process, keyed by (name, labels)
+
+    Labels are given as tuple of (key, value) pairs in fixed order.
+    """
+    def __init__(self):
+        self.histograms = dict()
+        self.counters = dict()
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def clear(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+
+registry = Registry()
+
+
+def observe(name, labels, value):
+    registry.observe(name, labels, value)
+
+
+def inc(name, labels=(), value=1):
+    registry.inc(name, labels, value)
+
+
+class timer(object):
+    """Context manager which observes block execution time"""
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(self.name, self.labels, perf_counter() - self.started)
+
+
+class MeteredEngine(object):
+    """Database engine proxy which times engine calls"""
+    METHODS = ('get_list', 'get_item', 'get_many', 'get_many_raw', 'check_exists',
+               'check_exists_many', 'put_item', 'put_many', 'get_stats', 'update_stats')
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __getattr__(self, name):
+        attr = getattr(self.engine, name)
+        if name not in self.METHODS:
+            return attr
+        labels = (('method', name),)
+
+        async def timed(*args, **kwargs):
+            with timer('dozorro_engine_seconds', labels):
+                return await attr(*args, **kwargs)
+        # bind once, next lookups don't reach __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+def format_labels(labels, extra=None):
+    if extra:
+        labels = labels + (extra,)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def render_gauges(app):
+    """Current state of caches and executors attached to app"""
+    from dozorro.api.validate import verify_stats
+    gauges = [
+        ('dozorro_sign_verify_count', (), verify_stats['count']),
+        ('dozorro_sign_verify_seconds', (), verify_stats['time']),
+    ]
+    sources = (
+        ('item_cache', getattr(app.get('db'), 'cache', None)),
+        ('tenders_cache', app.get('tenders_cache')),
+        ('validate_executor', app.get('validate_executor')),
+        ('changes', app.get('changes')),
+        ('write_batch', app.get('write_batch')),
+        ('compress', app.get('compress')),
+        ('admin_watcher', app.get('admin_watcher')),
+        ('replicas', app.get('replicas')),
+    )
+    for prefix, source in sources:
+        if source is None or not hasattr(source, 'stats'):
+            continue
+        for key, value in source.stats().items():
+            gauges.append(('dozorro_{}_{}'.format(prefix, key), (), value))
+    return gauges
+
+
+def render(app):
+    lines = list()
+    names = set()
+
+    def header(name, type):
+        if name not in names:
+            names.add(name)
+            if name in HELP:
+                lines.append('# HELP {} {}'.format(name, HELP[name]))
+            lines.append('# TYPE {} {}'.format(name, type))
+
+    for (name, labels), hist in sorted(registry.histograms.items()):
+        header(name, 'histogram')
+        total = 0
+        for le, count in zip(BUCKETS + ('+Inf',), hist.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels, ('le', le)), total))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), hist.sum))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), total))
+    for (name, labels), value in sorted(registry.counters.items()):
+        header(name, 'counter')
+        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    for name, labels, value in render_gauges(app):
+        header(name, 'gauge')
+        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+async def metrics_middleware(app, handler):
+    async def middleware_handler(request):
+        started = perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            route = request.match_info.route.name
+            if route and route not in SKIP_ROUTES:
+                labels = (('route', route), ('method', request.method))
+                registry.observe('dozorro_request_seconds', labels, perf_counter() - started)
+    return middleware_handler
+
+
+async def metrics_view(request):
+    body = render(request.app).encode('utf-8')
+    return Response(body=body, headers={'Content-Type': CONTENT_TYPE,
+                                        'Cache-Control': 'no-cache'})
+
+
+def setup_metrics(app, path='/metrics'):
+    app.router.add_route('GET', path, metrics_view, name='metrics_view')
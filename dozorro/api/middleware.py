@@ -5,6 +5,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+VALIDATE_ERRORS = (AssertionError, LookupError, TypeError, ValueError, ValidationError)
+
 
 async def dump_request(request):
     request_headers = "\n".join(["{}: {}".format(k, v)
@@ -23,6 +25,10 @@ async def dump_request(request):
                                   request_body)
 
 
+def error_message(e):
+    return '{}: {}'.format(e.__class__.__name__, str(e)[:100])
+
+
 def json_error(status, message):
     return json_response({'error': message}, status=status, dumps=dumps)
 
@@ -38,10 +44,10 @@ async def error_middleware(app, handler):
                 logger.error('HTTPException {} on {} {}'.format(e, method, path))
                 return json_error(e.status, e.reason)
             raise               # pragma: no cover
-        except (AssertionError, LookupError, TypeError, ValueError, ValidationError) as e:
+        except VALIDATE_ERRORS as e:
             request_dump = await dump_request(request)
             logger.exception('ValidateError on {}'.format(request_dump))
-            return json_error(400, '{}: {}'.format(e.__class__.__name__, str(e)[:100]))
+            return json_error(400, error_message(e))
         except Exception as e:  # pragma: no cover
             request_dump = await dump_request(request)
             logger.exception('Unhandled Exception on {}'.format(request_dump))
@@ -0,0 +1,166 @@
+import fcntl
+import asyncio
+import logging
+import sqlite3
+import threading
+import rapidjson as json
+from concurrent.futures import ThreadPoolExecutor
+from dozorro.api.utils import Client
+
+logger = logging.getLogger(__name__)
+
+
+class TendersMirror(object):
+    """Compact local index of tenders mode and contracts ids
+
+    Index is kept in sqlite file shared by all workers on the host, only one
+    of them (holder of the lock file) follows the tenders changes feed.
+    Lookups run in reader threads, each with own connection.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS tenders ("
+        "  id TEXT PRIMARY KEY, mode TEXT, contracts TEXT) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS feed (name TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(self, path, readers=2):
+        self.path = path
+        self.conn = self.connect()
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        self.lock_fp = None
+        self.sync_task = None
+        # all writes go through single thread with its own connection
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.writer = None
+        self.local = threading.local()
+        self.readers_conns = list()
+        self.readers_lock = threading.Lock()
+        self.readers = ThreadPoolExecutor(int(readers), thread_name_prefix='mirror-reader')
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    async def close(self):
+        if self.sync_task:
+            self.sync_task.cancel()
+            await asyncio.gather(self.sync_task, return_exceptions=True)
+            self.sync_task = None
+        await self.run_writer(self.close_writer)
+        self.executor.shutdown()
+        self.readers.shutdown()
+        with self.readers_lock:
+            for conn in self.readers_conns:
+                conn.close()
+            self.readers_conns = list()
+        self.conn.close()
+        if self.lock_fp:
+            self.lock_fp.close()
+            self.lock_fp = None
+
+    def reader_conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            with self.readers_lock:
+                self.readers_conns.append(conn)
+        return conn
+
+    def select(self, tender_id):
+        return self.reader_conn().execute('SELECT mode, contracts FROM tenders WHERE id = ?',
+                                          (tender_id,)).fetchone()
+
+    async def get(self, tender_id):
+        loop = asyncio.get_event_loop()
+        row = await loop.run_in_executor(self.readers, self.select, tender_id)
+        if not row:
+            return None
+        tender = {'id': tender_id}
+        if row[0]:
+            tender['mode'] = row[0]
+        if row[1]:
+            tender['contracts'] = [{'id': c} for c in json.loads(row[1])]
+        return tender
+
+    async def run_writer(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def close_writer(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def write(self, sql, rows, offset=None):
+        if not self.writer:
+            self.writer = self.connect()
+        with self.writer:
+            self.writer.execute('BEGIN')
+            self.writer.executemany(sql, rows)
+            if offset:
+                self.writer.execute('INSERT OR REPLACE INTO feed VALUES (?, ?)',
+                                    ('offset', offset))
+
+    async def store(self, tender):
+        contracts = [c['id'] for c in tender.get('contracts', [])]
+        row = (tender['id'], tender.get('mode'), json.dumps(contracts))
+        await self.run_writer(self.write, 'INSERT OR REPLACE INTO tenders VALUES (?, ?, ?)', [row])
+
+    async def update(self, tenders, offset=None):
+        # feed has no contracts, keep ones stored by previous lookups
+        sql = ('INSERT INTO tenders (id, mode) VALUES (?, ?) '
+               'ON CONFLICT(id) DO UPDATE SET mode = excluded.mode')
+        rows = [(t['id'], t.get('mode')) for t in tenders]
+        await self.run_writer(self.write, sql, rows, offset)
+
+    def feed_offset(self):
+        row = self.conn.execute("SELECT value FROM feed WHERE name = 'offset'").fetchone()
+        return row[0] if row else None
+
+    def try_lock(self):
+        if not self.lock_fp:
+            self.lock_fp = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(self.lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    async def sync(self, config, loop, interval=10):
+        params = {'descending': '', 'opt_fields': 'mode'}
+        client = None
+        while True:
+            try:
+                if not self.try_lock():
+                    await asyncio.sleep(interval)
+                    continue
+                if not client:
+                    client = await Client.create(config, loop, params)
+                    offset = self.feed_offset()
+                    if offset:
+                        client.params['offset'] = offset
+                    logger.info('Follow tenders feed from offset {}'.format(offset))
+                tenders = await client.get_tenders()
+                await self.update(tenders, client.params.get('offset'))
+                if not tenders:
+                    await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                break
+            except Exception:   # pragma: no cover
+                logger.exception('TendersMirror.Sync')
+                await asyncio.sleep(interval)
+
+
+async def init_mirror(app, loop):
+    config = app['config']['tenders']
+    options = config['mirror']
+    mirror = TendersMirror(options['path'], int(options.get('readers', 2)))
+    if options.get('sync', True):
+        coro = mirror.sync(config, loop, float(options.get('interval', 10)))
+        mirror.sync_task = loop.create_task(coro)
+    app['mirror'] = mirror
+    return mirror
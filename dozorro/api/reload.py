@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from dozorro.api.backend import pack_offset, unpack_offset
+from dozorro.api.validate import Keyring, compile_schema
+
+logger = logging.getLogger(__name__)
+
+ADMIN_MODELS = ('admin/pubkey', 'admin/schema')
+
+
+class AdminWatcher(object):
+    """Apply admin documents stored in database to keyring and schemas
+
+    At start all admin/pubkey and admin/schema items not loaded from files
+    are applied in ts order. Then new items are found by model filtered
+    list, polled from the last seen ts minus settle time, because items of
+    other workers may be committed with a bit older ts. New keyring, schemas
+    and validators are built aside and replaced in app at once.
+    """
+    def __init__(self, app, interval=10, settle=5, page=100):
+        self.app = app
+        self.interval = float(interval)
+        self.settle = float(settle)
+        self.page = int(page)
+        self.since = dict()
+        self.seen = set()
+        self.task = None
+        self.applied = 0
+        self.errors = 0
+
+    async def start(self):
+        # items loaded from files are already applied
+        self.seen.update(self.app.get('admin_ids', ()))
+        for model in ADMIN_MODELS:
+            self.since[model] = None
+        # full scan of admin items stored through API, there are few of them
+        await self.poll()
+        self.task = asyncio.ensure_future(self.watch())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                break
+            except Exception:   # pragma: no cover
+                logger.exception('AdminWatcher.Poll')
+
+    async def new_ids(self, model):
+        db = self.app['db']
+        since = self.since[model]
+        offset = pack_offset(since - self.settle) if since else None
+        new_ids = list()
+        while True:
+            items, _, last = await db.get_list(offset, self.page, filters={'model': model})
+            new_ids.extend(item['id'] for item in items if item['id'] not in self.seen)
+            if last:
+                since = max(since or 0, unpack_offset(last)[0])
+            if len(items) < self.page:
+                break
+            offset = last
+        self.since[model] = since
+        return new_ids
+
+    async def fetch(self, model):
+        new_ids = await self.new_ids(model)
+        if not new_ids:
+            return []
+        found = {data['id']: data for data in await self.app['db'].get_many(new_ids)}
+        return [found[i] for i in new_ids if i in found]
+
+    async def poll(self):
+        keys = await self.fetch('admin/pubkey')
+        schemas = await self.fetch('admin/schema')
+        if keys or schemas:
+            self.apply(keys, schemas)
+
+    def apply(self, keys, schemas_docs):
+        app = self.app
+        payloads = list(app['keyring_payloads'])
+        schemas = dict(app['schemas'])
+        validators = dict(app['validators'])
+        schema_backend = app['config'].get('schema_backend')
+        applied = list()
+        for data in keys + schemas_docs:
+            self.seen.add(data['id'])
+            payload = data['envelope']['payload']
+            try:
+                if data['envelope']['model'] == 'admin/pubkey':
+                    # check key before it goes to keyring
+                    Keyring().add(payload)
+                    payloads.append(payload)
+                else:
+                    model, name = payload['model'].split('/')
+                    schema = payload['schema']
+                    if 'definitions' not in schema:
+                        schema['definitions'] = schemas['comment']['definitions']
+                    validators[name] = compile_schema(schema, schema_backend)
+                    schemas[name] = schema
+            except Exception as e:
+                self.errors += 1
+                logger.error('Admin item {} not applied: {}'.format(data['id'], e))
+                continue
+            applied.append(data['id'])
+        if not applied:
+            return
+        keyring = Keyring()
+        for payload in payloads:
+            keyring.add(payload)
+        # no awaits below, requests see either old or new state
+        app['keyring'] = keyring
+        app['keyring_payloads'] = payloads
+        app['schemas'] = schemas
+        app['validators'] = validators
+        self.applied += len(applied)
+        logger.info('Applied admin items {}'.format(', '.join(applied)))
+
+    def stats(self):
+        return {
+            'applied': self.applied,
+            'errors': self.errors
+        }
+
+
+async def init_watcher(app):
+    options = app['config']['reload']
+    if not isinstance(options, dict):
+        options = {}
+    app['admin_watcher'] = AdminWatcher(app, **options)
+    await app['admin_watcher'].start()
+    return app['admin_watcher']
@@ -0,0 +1,344 @@
+"""HTTP API benchmark
+
+Starts the app from main.init_app against database from given config,
+serves tenders from local stand-in and drives mix of list pages, multi-id
+item GETs and PUTs of signed comments at fixed concurrency. Result is
+printed (or saved) as JSON, so runs can be compared.
+
+    python -m dozorro.api.tests.benchmark --config tests/api_rethink.yaml \\
+        --dropdb --items 2000 --requests 10000 --concurrency 20
+
+Database from config is dropped and created again.
+"""
+import os
+import copy
+import shutil
+import random
+import asyncio
+import argparse
+import tempfile
+import platform
+import ed25519
+import rapidjson as json
+from time import perf_counter
+from datetime import datetime, timedelta
+from aiohttp import web, ClientSession, TCPConnector
+from dozorro.api import backend, utils
+from dozorro.api.main import init_app, shutdown_app
+from dozorro.api.validate import TZ, dumps, hash_id
+
+ROOTJS = "tests/keyring/root.json"
+SECKEY = "tests/keypair.pem"
+COMMENT_SCHEMA = "tests/comment_schema.json"
+COMMENT_SAMPLE = "tests/comment_sample.json"
+PREFIX = "/api/v1"
+
+
+def data_sign(data, sk):
+    data['envelope']['date'] = TZ.localize(datetime.now()).isoformat()
+    data_bin = dumps(data['envelope'],
+        skipkeys=False,
+        ensure_ascii=False,
+        sort_keys=True).encode('utf-8')
+    data['id'] = hash_id(data_bin)
+    data['sign'] = sk.sign(data_bin, encoding='base64').decode()
+    return data
+
+
+def tender_ids(count):
+    return [hash_id('tender{}'.format(n).encode()) for n in range(count)]
+
+
+async def start_site(app, host='127.0.0.1'):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, 'http://{}:{}'.format(host, port)
+
+
+def tenders_app(tenders, latency=0.0):
+    """Stand-in for tenders API, each tender has one contract"""
+    async def tenders_list(request):
+        return web.json_response({'data': [{'id': t} for t in tenders]})
+
+    async def tender_view(request):
+        tender_id = request.match_info['tender_id']
+        if latency:
+            await asyncio.sleep(latency)
+        if tender_id not in tenders:
+            raise web.HTTPNotFound()
+        tender = {'id': tender_id, 'contracts': [{'id': hash_id(tender_id.encode())}]}
+        return web.json_response({'data': tender})
+
+    app = web.Application()
+    app['tenders'] = set(tenders)
+    app.router.add_get('/api/2.5/tenders', tenders_list)
+    app.router.add_get('/api/2.5/tenders/{tender_id}', tender_view)
+    return app
+
+
+def write_json(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wt') as fp:
+        fp.write(json.dumps(data, ensure_ascii=False))
+
+
+async def init_database(config, sk, tmpdir):
+    """Create database with root key and comment schema, both signed now
+
+    Root key of tests keyring may be expired, so key for the same keypair
+    is signed again with validity around the benchmark run.
+    """
+    app = {'config': config}
+    with open(ROOTJS) as fp:
+        root_key = json.loads(fp.read())
+    now = TZ.localize(datetime.now())
+    root_key['envelope']['payload']['validSince'] = (now - timedelta(days=1)).isoformat()
+    root_key['envelope']['payload']['validTill'] = (now + timedelta(days=30)).isoformat()
+    root_key = data_sign(root_key, sk)
+    with open(COMMENT_SCHEMA) as fp:
+        schema = data_sign(json.loads(fp.read()), sk)
+    await backend.init_engine(app)
+    await app['db'].init_tables(True)
+    await app['db'].put_item(copy.deepcopy(root_key))
+    await app['db'].put_item(copy.deepcopy(schema))
+    await app['db'].close()
+    config['keyring'] = os.path.join(tmpdir, 'keyring')
+    config['schemas'] = os.path.join(tmpdir, 'schemas')
+    write_json(os.path.join(config['keyring'], 'root.json'), root_key)
+    write_json(os.path.join(config['schemas'], 'comment.json'), schema)
+    return schema['id']
+
+
+def make_forms(count, tenders, parent_id, sk, rnd):
+    with open(COMMENT_SAMPLE) as fp:
+        sample = json.loads(fp.read())
+    payload = sample['envelope']['payload']
+    payload['parentForm'] = parent_id
+    comment = payload['comment']
+    forms = list()
+    for n in range(count):
+        data = copy.deepcopy(sample)
+        data['envelope']['payload']['tender'] = rnd.choice(tenders)
+        data['envelope']['payload']['comment'] = '{} #{}'.format(comment, n)
+        forms.append(data_sign(data, sk))
+    return forms
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    n = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(n, len(values) - 1)]
+
+
+class Recorder(object):
+    """Latencies and status counts by operation"""
+    def __init__(self):
+        self.latency = dict()
+        self.errors = dict()
+        self.started = perf_counter()
+        self.finished = None
+
+    def add(self, op, elapsed, ok):
+        self.latency.setdefault(op, []).append(elapsed)
+        if not ok:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def stop(self):
+        self.finished = perf_counter()
+
+    def report(self):
+        elapsed = (self.finished or perf_counter()) - self.started
+        result = {'elapsed': round(elapsed, 3), 'ops': {}}
+        total = 0
+        for op, values in sorted(self.latency.items()):
+            values.sort()
+            total += len(values)
+            result['ops'][op] = {
+                'count': len(values),
+                'errors': self.errors.get(op, 0),
+                'rps': round(len(values) / elapsed, 1),
+                'mean_ms': round(1000 * sum(values) / len(values), 3),
+                'p50_ms': round(1000 * percentile(values, 50), 3),
+                'p95_ms': round(1000 * percentile(values, 95), 3),
+                'p99_ms': round(1000 * percentile(values, 99), 3),
+                'max_ms': round(1000 * values[-1], 3),
+            }
+        result['count'] = total
+        result['errors'] = sum(self.errors.values())
+        result['rps'] = round(total / elapsed, 1) if elapsed else 0
+        return result
+
+
+class Benchmark(object):
+    def __init__(self, session, api_url, args, rnd):
+        self.session = session
+        self.api_url = api_url + PREFIX
+        self.args = args
+        self.rnd = rnd
+        self.ids = list()
+        self.offsets = [None]
+        self.headers = {'Content-Type': 'application/json', 'User-Agent': 'benchmark root'}
+
+    async def put(self, data):
+        url = '{}/data/{}'.format(self.api_url, data['id'])
+        async with self.session.put(url, data=json.dumps(data), headers=self.headers) as resp:
+            await resp.read()
+            if resp.status == 201:
+                self.ids.append(data['id'])
+            return resp.status == 201
+
+    async def get_list(self, offset=None):
+        params = {'limit': str(self.args.page)}
+        if offset:
+            params['offset'] = offset
+        async with self.session.get(self.api_url + '/data', params=params) as resp:
+            data = await resp.json()
+            return resp.status == 200, data
+
+    async def get_items(self, ids):
+        url = '{}/data/{}'.format(self.api_url, ','.join(ids))
+        async with self.session.get(url) as resp:
+            await resp.read()
+            return resp.status == 200
+
+    async def collect_offsets(self):
+        offset = None
+        while True:
+            ok, data = await self.get_list(offset)
+            if not ok or not data['data'] or 'next_page' not in data:
+                break
+            offset = data['next_page']['offset']
+            self.offsets.append(offset)
+
+    async def run_op(self, op, forms, recorder):
+        started = perf_counter()
+        try:
+            if op == 'put':
+                ok = await self.put(forms.pop())
+            elif op == 'list':
+                ok, _ = await self.get_list(self.rnd.choice(self.offsets))
+            else:
+                ids = self.rnd.sample(self.ids, min(self.args.ids, len(self.ids)))
+                ok = await self.get_items(ids)
+        except Exception:
+            ok = False
+        recorder.add(op, perf_counter() - started, ok)
+
+    async def run(self, ops, forms):
+        recorder = Recorder()
+        ops = iter(ops)
+
+        async def worker():
+            for op in ops:
+                await self.run_op(op, forms, recorder)
+
+        await asyncio.gather(*[worker() for _ in range(self.args.concurrency)])
+        recorder.stop()
+        return recorder
+
+
+def parse_mix(mix):
+    weights = dict()
+    for part in mix.split(','):
+        op, _, weight = part.partition('=')
+        if op not in ('list', 'item', 'put'):
+            raise ValueError('Unknown operation in mix: %s' % op)
+        weights[op] = float(weight or 1)
+    return weights
+
+
+async def benchmark(args):
+    rnd = random.Random(args.seed)
+    config = utils.load_config(args.config, configure_logging=False)
+    weights = parse_mix(args.mix)
+    ops = rnd.choices(list(weights), list(weights.values()), k=args.requests)
+
+    with open(SECKEY) as fp:
+        sk = ed25519.SigningKey(fp.read().encode(), encoding='base64')
+    tenders = tender_ids(args.tenders)
+    tenders_runner, tenders_url = await start_site(tenders_app(tenders, args.tenders_latency))
+    tmpdir = tempfile.mkdtemp(prefix='benchmark')
+    config['tenders'] = dict(config.get('tenders', {}), url=tenders_url + '/api/2.5/tenders')
+    config['tenders'].pop('mirror', None)
+    config.pop('archive', None)
+    config.pop('readonly', None)
+
+    parent_id = await init_database(config, sk, tmpdir)
+    started = perf_counter()
+    forms = make_forms(args.items + ops.count('put'), tenders, parent_id, sk, rnd)
+    sign_time = perf_counter() - started
+
+    app = await init_app(config)
+    api_runner, api_url = await start_site(app)
+
+    try:
+        connector = TCPConnector(limit=args.concurrency)
+        async with ClientSession(connector=connector) as session:
+            bench = Benchmark(session, api_url, args, rnd)
+            seed_forms = [forms.pop() for _ in range(args.items)]
+            load = await bench.run(['put'] * args.items, seed_forms)
+            await bench.collect_offsets()
+            mixed = await bench.run(ops, forms)
+    finally:
+        await api_runner.cleanup()
+        await shutdown_app(app)
+        await tenders_runner.cleanup()
+        shutil.rmtree(tmpdir)
+
+    return {
+        'engine': config['database']['engine'],
+        'config': args.config,
+        'python': platform.python_version(),
+        'params': {
+            'items': args.items,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'mix': weights,
+            'ids': args.ids,
+            'page': args.page,
+            'tenders': args.tenders,
+            'tenders_latency': args.tenders_latency,
+            'seed': args.seed,
+        },
+        'sign_time': round(sign_time, 3),
+        'load': load.report(),
+        'mixed': mixed.report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dozorro API')
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--dropdb', action='store_true',
+                        help='confirm database from config can be dropped')
+    parser.add_argument('--items', type=int, default=1000,
+                        help='signed items to load before mixed run')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--mix', default='list=3,item=5,put=2',
+                        help='operations weights, list, item and put')
+    parser.add_argument('--ids', type=int, default=10, help='ids per item GET')
+    parser.add_argument('--page', type=int, default=100, help='list page limit')
+    parser.add_argument('--tenders', type=int, default=500)
+    parser.add_argument('--tenders-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    if not args.dropdb:
+        parser.error('database from config will be dropped, pass --dropdb')
+
+    result = asyncio.get_event_loop().run_until_complete(benchmark(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'wt') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
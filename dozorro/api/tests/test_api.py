@@ -1,19 +1,30 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import glob
 import json
 import pytz
 import asyncio
 import ed25519
 import pytest
 from aiohttp import web
+from aiohttp.test_utils import TestServer
 from random import randint
 from datetime import datetime
 from unittest.mock import patch
 from dozorro.api.main import init_app, shutdown_app
 from dozorro.api.console import cdb_init, cdb_put, cdb_verify
-from dozorro.api.validate import dumps, hash_id
-from dozorro.api.utils import load_schemas
+from dozorro.api.validate import dumps, hash_id, compile_schema, Keyring
+from jsonschema.exceptions import ValidationError
+from dozorro.api.utils import load_keyring_schemas, load_schemas, TenderCache
+from dozorro.api.backend import BatchedEngine, ItemCache, ReplicatedEngine, count_stats, pack_offset, \
+    stats_models, unpack_offset
+from dozorro.api.mirror import TendersMirror
+from dozorro.api.backend.shared_cache import SharedItemCache
+from dozorro.api import metrics
+from dozorro.api.changes import ChangesHub
+from dozorro.api.reload import AdminWatcher
+from dozorro.api.compress import Compressor, accepted_encodings, etag_base
 
 
 ROOTJS = "tests/keyring/root.json"
@@ -37,6 +48,399 @@ def test_hash_id():
     assert hash_id(dump_bson(data)) == data['id']
 
 
+def test_pack_offset():
+    item_id = 'a' * 32
+    assert unpack_offset(pack_offset(1.5, item_id)) == (1.5, item_id)
+    assert unpack_offset(pack_offset(1.5)) == (1.5, None)
+    assert pack_offset(None) is None
+    for offset in ('', 'zzz', '0' * 17, '0' * 16 + 'g' * 32):
+        with pytest.raises(ValueError):
+            unpack_offset(offset)
+
+
+def test_count_stats():
+    items = [
+        {'envelope': {'model': 'form/comment', 'owner': 'a', 'date': '2026-01-02T00:00:00',
+                      'payload': {'tender': 't1'}}},
+        {'envelope': {'model': 'admin/schema', 'owner': 'a:b', 'date': '2026-01-02T01:00:00',
+                      'payload': {}}},
+    ]
+    counts = count_stats(items)
+    assert counts['owner:a:form/comment'] == 1
+    assert counts['day:2026-01-02:admin/schema'] == 1
+    assert counts['tender:t1:form/comment'] == 1
+    assert len(counts) == 7
+    rows = sorted(counts.items())
+    assert stats_models('owner:a:', rows) == {'form/comment': 1}
+    assert stats_models('day:2026-01-02:', rows) == {'admin/schema': 1, 'form/comment': 1}
+
+
+def test_compress_negotiation():
+    assert accepted_encodings('gzip, deflate, br;q=0') == {'gzip', 'deflate'}
+    assert accepted_encodings('gzip;q=0.5, *;q=0') == {'gzip'}
+    compressor = Compressor(encodings=['gzip'])
+    assert compressor.choose('br, gzip')[0] == 'gzip'
+    assert compressor.choose('identity')[0] is None
+    assert etag_base('"abc-gzip"') == '"abc"'
+    assert etag_base('"abc"') == '"abc"'
+    with pytest.raises(ValueError):
+        Compressor(encodings=['lzma'])
+
+
+def test_item_cache():
+    cache = ItemCache(max_items=2, max_bytes=1000)
+    cache.put('a', {'id': 'a'})
+    cache.put('b', {'id': 'b'})
+    assert cache.get('a') == {'id': 'a'}
+    cache.put('c', {'id': 'c'})
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    cache.put('d', {'id': 'd', 'data': 'x' * 2000})
+    assert 'd' not in cache
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_shared_item_cache():
+    os.makedirs(TMPDIR, exist_ok=True)
+    filename = TMPDIR + '/items.cache'
+    if os.path.exists(filename):
+        os.remove(filename)
+    cache = SharedItemCache(filename, max_items=16, max_bytes=4096)
+    other = SharedItemCache(filename, max_items=16, max_bytes=4096)
+    cache.put('a' * 32, {'id': 'a' * 32})
+    assert other.get('a' * 32) == {'id': 'a' * 32}
+    assert other.get('b' * 32) is None
+    assert other.stats()['hits'] == 1 and other.stats()['misses'] == 1
+    # ring buffer arena, old items are evicted by new ones
+    for n in range(100):
+        cache.put_data('%032x' % n, b'x' * 100)
+    assert 'a' * 32 not in other
+    assert '%032x' % 99 in other
+    assert 0 < len(other) <= 16
+    cache.close()
+    other.close()
+    os.remove(filename)
+
+
+async def test_tender_cache(loop):
+    calls = []
+
+    async def fetch(tender_id, app):
+        calls.append(tender_id)
+        await asyncio.sleep(0.01)
+        if tender_id == 'bad':
+            raise ValueError('tender not found')
+        return {'id': tender_id}
+
+    cache = TenderCache(fetch, ttl=60, negative_ttl=60)
+    tenders = await asyncio.gather(*[cache.get('a', None) for _ in range(10)])
+    assert tenders[0] == {'id': 'a'}
+    assert calls == ['a']
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            await cache.get('bad', None)
+    assert calls == ['a', 'bad']
+    await cache.get('a', None, refresh=True)
+    assert calls == ['a', 'bad', 'a']
+
+
+async def test_batched_engine(loop):
+    batches = []
+
+    class BulkEngine:
+        async def put_many(self, items, table='data'):
+            batches.append([data['id'] for data in items])
+            return ['duplicate' if data['id'] == 'b' else 'created' for data in items]
+
+    db = BatchedEngine(BulkEngine(), max_size=3, max_delay=0.01)
+    result = await asyncio.gather(*[db.put_item({'id': i}) for i in 'abcd'],
+                                  return_exceptions=True)
+    assert batches == [['a', 'b', 'c'], ['d']]
+    assert result[0] is True and result[3] is True
+    assert isinstance(result[1], ValueError)
+    assert db.stats() == {'pending': 0, 'batches': 2, 'items': 4}
+
+
+async def test_replicated_engine(loop):
+    class DictEngine:
+        def __init__(self, items, fail=False):
+            self.items = items
+            self.fail = fail
+
+        async def get_item(self, item_id, table='data'):
+            if self.fail:
+                raise ConnectionError('replica down')
+            return self.items.get(item_id)
+
+        async def check_exists(self, item_id, table='data', model=None):
+            assert item_id in self.items, '{} not found'.format(item_id)
+            return True
+
+        async def put_item(self, data, table='data'):
+            self.items[data['id']] = data
+            return True
+
+    primary = DictEngine({'a': {'id': 'a'}})
+    stale = DictEngine({'a': {'id': 'a', 'replica': 1}})
+    down = DictEngine({}, fail=True)
+    db = ReplicatedEngine(primary, [stale, down], retry_after=60)
+    await db.put_item({'id': 'b'})
+    assert 'b' in primary.items and 'b' not in stale.items
+    assert await db.get_item('a') == {'id': 'a', 'replica': 1}
+    assert await db.get_item('a') == {'id': 'a'}
+    assert await db.get_item('b') == {'id': 'b'}
+    assert await db.check_exists('b')
+    assert db.stats() == {'replicas': 2, 'down': 1, 'reads': 4, 'errors': 1, 'fallbacks': 3}
+    db.read_your_writes = False
+    assert await db.get_item('b') is None
+    with pytest.raises(AssertionError):
+        await db.check_exists('b')
+
+
+async def test_couch_engine_views(loop):
+    from dozorro.api.backend.couch.engine import CouchEngine
+    docs = {'a' * 32: 1.0, 'b' * 32: 2.0}
+
+    async def head_db(request):
+        return web.json_response({})
+
+    async def all_docs(request):
+        keys = (await request.json())['keys']
+        rows = [{'id': k, 'key': k, 'value': {'rev': '1-x'}} if k in docs else
+                {'key': k, 'error': 'not_found'} for k in keys]
+        return web.json_response({'total_rows': len(docs), 'offset': 0, 'rows': rows})
+
+    async def view(request):
+        if request.match_info['name'] == 'stats':
+            return web.json_response({'rows': [{'key': ['model', 'form/x', 'form/x'],
+                                                'value': 2}]})
+        rows = [{'id': k, 'key': ts, 'value': None} for k, ts in sorted(docs.items())]
+        return web.json_response({'total_rows': len(docs), 'offset': 0, 'rows': rows})
+
+    couch = web.Application()
+    couch.router.add_route('HEAD', '/test', head_db)
+    couch.router.add_post('/test/_all_docs', all_docs)
+    couch.router.add_get('/test/_design/data/_view/{name}', view)
+    server = TestServer(couch)
+    await server.start_server()
+    db = CouchEngine()
+    await db.init_engine({'config': {'database': {
+        'engine': 'couch', 'server': str(server.make_url('')).rstrip('/'),
+        'database': 'test'}}})
+    try:
+        assert await db.check_exists_many(list(docs))
+        with pytest.raises(AssertionError):
+            await db.check_exists_many(['a' * 32, 'c' * 32])
+        items, first, last = await db.get_list()
+        assert items == [{'id': 'a' * 32}, {'id': 'b' * 32}]
+        assert last == pack_offset(2.0, 'b' * 32)
+        assert await db.get_stats('model', 'form/x') == {'form/x': 2}
+    finally:
+        await db.close()
+        await server.close()
+
+
+async def test_tenders_mirror(loop):
+    os.makedirs(TMPDIR, exist_ok=True)
+    filename = TMPDIR + '/tenders.db'
+    for fn in glob.glob(filename + '*'):
+        os.remove(fn)
+    mirror = TendersMirror(filename)
+    await mirror.update([{'id': 'a', 'mode': 'test'}, {'id': 'b'}], 'offset1')
+    assert await mirror.get('a') == {'id': 'a', 'mode': 'test'}
+    assert await mirror.get('c') is None
+    await mirror.store({'id': 'b', 'contracts': [{'id': 'c1'}]})
+    await mirror.update([{'id': 'b'}], 'offset2')
+    assert await mirror.get('b') == {'id': 'b', 'contracts': [{'id': 'c1'}]}
+    assert mirror.feed_offset() == 'offset2'
+    assert mirror.try_lock()
+    await mirror.close()
+    for fn in glob.glob(filename + '*'):
+        os.remove(fn)
+
+
+async def test_startup_snapshot(loop):
+    checked = []
+
+    class ExistsEngine:
+        async def check_exists_many(self, items_ids, table='data'):
+            checked.extend(items_ids)
+            return True
+
+    schemas = TMPDIR + '/snapshot_schemas'
+    os.makedirs(schemas, exist_ok=True)
+    with open(COMMENT_SCHEMA) as fp:
+        comment_schema = json.load(fp)
+    with open(schemas + '/comment.json', 'wt') as fp:
+        json.dump(comment_schema, fp)
+    snapshot = TMPDIR + '/snapshot.json'
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+    config = {'database': {'engine': 'test'}, 'keyring': 'tests/keyring',
+              'schemas': schemas, 'startup_snapshot': snapshot}
+    for _ in range(2):
+        app = {'config': config, 'db': ExistsEngine()}
+        await load_keyring_schemas(app)
+        assert list(app['keyring']) == ['root']
+        assert list(app['validators']) == ['comment']
+    with open(snapshot) as fp:
+        assert 'test' not in json.load(fp)['fingerprint']['database']
+    # second start is served from snapshot without database checks
+    assert checked.count(comment_schema['id']) == 1
+    assert len(checked) == 2
+    os.remove(snapshot)
+    os.remove(schemas + '/comment.json')
+
+
+def test_keyring():
+    with open(ROOTJS) as fp:
+        root_key = json.load(fp)
+    keyring = Keyring()
+    payload = dict(root_key['envelope']['payload'])
+    keyring.add(payload)
+    payload.update(validSince='2016-01-01T00:00:00+02:00', validTill='2016-06-01T00:00:00+02:00')
+    keyring.add(payload)
+    date = TZ.localize(datetime(2016, 3, 1))
+    assert len(list(keyring.find('root', date))) == 2
+    date = TZ.localize(datetime(2017, 3, 1))
+    assert len(list(keyring.find('root', date))) == 1
+    date = TZ.localize(datetime(2014, 3, 1))
+    assert len(list(keyring.find('root', date))) == 0
+    assert len(list(keyring.find('nobody', date))) == 0
+
+
+def test_admin_watcher_apply():
+    with open(ROOTJS) as fp:
+        root_key = json.load(fp)
+    with open(COMMENT_SCHEMA) as fp:
+        comment_schema = json.load(fp)
+    with open(FORM113_SCHEMA) as fp:
+        form113_schema = json.load(fp)
+    schema = comment_schema['envelope']['payload']['schema']
+    app = {'config': {}, 'keyring_payloads': [root_key['envelope']['payload']],
+           'keyring': Keyring(), 'schemas': {'comment': schema},
+           'validators': {'comment': compile_schema(schema)}}
+    new_key = json.loads(json.dumps(root_key))
+    new_key['id'] = 'b' * 32
+    new_key['envelope']['payload']['owner'] = 'new owner'
+    bad_schema = json.loads(json.dumps(form113_schema))
+    bad_schema['id'] = 'c' * 32
+    bad_schema['envelope']['payload']['schema'] = {'type': 12}
+    validators = app['validators']
+    watcher = AdminWatcher(app)
+    watcher.apply([new_key], [form113_schema, bad_schema])
+    assert sorted(app['keyring']) == ['new owner', 'root']
+    assert sorted(app['validators']) == ['comment', 'tender113']
+    assert app['validators'] is not validators
+    assert watcher.stats() == {'applied': 2, 'errors': 1}
+    assert new_key['id'] in watcher.seen
+
+
+async def test_admin_watcher_start(loop):
+    with open(ROOTJS) as fp:
+        root_key = json.load(fp)
+    with open(COMMENT_SCHEMA) as fp:
+        comment_schema = json.load(fp)
+
+    class AdminEngine:
+        def __init__(self):
+            self.items = []
+
+        async def put_item(self, data, table='data'):
+            self.items.append(data)
+            return True
+
+        async def get_list(self, offset=None, limit=100, reverse=False, table='data',
+                           filters=None):
+            items = [data for data in self.items
+                     if data['envelope']['model'] == filters['model']]
+            start = int(offset[-32:], 16) if offset else 0
+            items_list = [{'id': data['id']} for data in items[start:start + limit]]
+            last = pack_offset(1, '%032x' % (start + len(items_list))) if items_list else None
+            return (items_list, None, last)
+
+        async def get_many(self, items_list, table='data'):
+            return [data for data in self.items if data['id'] in items_list]
+
+    schema = comment_schema['envelope']['payload']['schema']
+    db = AdminEngine()
+    await db.put_item(root_key)
+    await db.put_item(comment_schema)
+    new_key = json.loads(json.dumps(root_key))
+    new_key['id'] = 'b' * 32
+    new_key['envelope']['payload']['owner'] = 'new owner'
+    await db.put_item(new_key)
+    # restart, keyring and schemas are loaded from files again
+    for _ in range(2):
+        app = {'config': {}, 'db': db, 'admin_ids': {root_key['id'], comment_schema['id']},
+               'keyring_payloads': [root_key['envelope']['payload']],
+               'keyring': Keyring(), 'schemas': {'comment': schema},
+               'validators': {'comment': compile_schema(schema)}}
+        watcher = AdminWatcher(app, page=1)
+        await watcher.start()
+        await watcher.close()
+        assert sorted(app['keyring']) == ['new owner', 'root']
+        assert watcher.stats() == {'applied': 1, 'errors': 0}
+
+
+def test_compile_schema():
+    with open(COMMENT_SCHEMA) as fp:
+        schema = json.load(fp)['envelope']['payload']['schema']
+    with open(COMMENT_SAMPLE) as fp:
+        payload = json.load(fp)['envelope']['payload']
+    validate = compile_schema(schema)
+    validate(payload)
+    payload.pop('tender')
+    with pytest.raises(ValidationError) as e:
+        validate(payload)
+    assert 'required property' in str(e.value)
+    with pytest.raises(ValueError):
+        compile_schema(schema, 'unknown')
+
+
+async def test_changes_hub(loop):
+    feed = asyncio.Queue()
+
+    class FeedEngine:
+        async def changes(self):
+            while True:
+                yield await feed.get()
+
+    hub = ChangesHub(FeedEngine(), queue_size=2, max_subscribers=2)
+    ids_sub = hub.subscribe()
+    docs_sub = hub.subscribe(docs=True)
+    with pytest.raises(OverflowError):
+        hub.subscribe()
+    await feed.put({'id': 'a' * 32, 'envelope': {}})
+    data = await asyncio.wait_for(ids_sub.get(), 1)
+    assert data == b'id: ' + b'a' * 32 + b'\ndata: {"id":"' + b'a' * 32 + b'"}\n\n'
+    data = await asyncio.wait_for(docs_sub.get(), 1)
+    assert b'"envelope":{}' in data
+    for n in range(3):
+        hub.publish({'id': str(n)})
+    assert ids_sub.overflow and docs_sub.overflow
+    assert await ids_sub.get() is None
+    assert not hub.subscribers and hub.feed_task is None
+    await hub.close()
+
+
+def test_metrics_render():
+    registry = metrics.Registry()
+    registry.observe('test_seconds', (('stage', 'one'),), 0.003)
+    registry.observe('test_seconds', (('stage', 'one'),), 20)
+    registry.inc('test_total')
+    registry.inc('test_total', value=2)
+    with patch.object(metrics, 'registry', registry):
+        text = metrics.render({})
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{stage="one",le="0.0025"} 0' in text
+    assert 'test_seconds_bucket{stage="one",le="0.005"} 1' in text
+    assert 'test_seconds_bucket{stage="one",le="+Inf"} 2' in text
+    assert 'test_seconds_count{stage="one"} 2' in text
+    assert 'test_total 3' in text
+
+
 def get_now():
     return TZ.localize(datetime.now())
 
@@ -96,7 +500,7 @@ async def put_data(loop, config):
 
 
 def verify_database(loop, config):
-    testargs = ["cdb_verify", "--config", config]
+    testargs = ["cdb_verify", "--workers", "2", "--config", config]
     with patch.object(sys, 'argv', testargs):
         cdb_verify()
 
@@ -383,6 +787,17 @@ async def api_tests(test_client, loop, config):
 
     form113_sample = data
 
+    # bulk put of already stored items
+    url = PREFIX + '/data/_bulk'
+    body = "\n".join([json.dumps(comment_sample), json.dumps(form113_sample)])
+    headers = {'Content-Type': 'application/x-ndjson'}
+    headers.update(ua)
+    resp = await client.post(url, data=body, headers=headers)
+    assert resp.status == 200
+    bulk = await resp.json()
+    assert bulk['created'] == 0
+    assert [s['status'] for s in bulk['data']] == ['duplicate', 'duplicate']
+
     url = PREFIX + '/data'
     resp = await client.get(url)
     assert resp.status == 200
@@ -394,6 +809,15 @@ async def api_tests(test_client, loop, config):
     assert data['data'][3]['id'] == comment_sample['id']
     assert data['data'][4]['id'] == form113_sample['id']
 
+    url = PREFIX + '/export'
+    resp = await client.get(url)
+    assert resp.status == 200
+    lines = (await resp.text()).splitlines()
+    assert len(lines) == 6
+    assert json.loads(lines[0])['id'] == root_key['id']
+    assert json.loads(lines[4])['id'] == form113_sample['id']
+    assert json.loads(lines[5])['next_page'] == data['next_page']
+
     url = PREFIX + '/data?limit=1000000'
     resp = await client.get(url)
     assert resp.status == 400
@@ -434,6 +858,63 @@ async def api_tests(test_client, loop, config):
     data = await resp.json()
     assert len(data['data']) == 2
 
+    # old ts only offsets are still accepted
+    assert len(next_page_offset) == 48
+    url = PREFIX + '/data?limit=3&offset=%s' % next_page_offset[:16]
+    resp = await client.get(url)
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data['data']) == 2
+
+    url = PREFIX + '/data?model=admin/schema'
+    resp = await client.get(url)
+    assert resp.status == 200
+    data = await resp.json()
+    assert [i['id'] for i in data['data']] == [comment_schema['id'], form113_schema['id']]
+    assert data['next_page']['model'] == 'admin/schema'
+
+    url = PREFIX + '/data?limit=1&reverse=1&tender=' + tender_id
+    resp = await client.get(url)
+    assert resp.status == 200
+    data = await resp.json()
+    assert [i['id'] for i in data['data']] == [form113_sample['id']]
+
+    url = PREFIX + '/data?reverse=1&owner=root'
+    resp = await client.get(url)
+    assert resp.status == 200
+    data = await resp.json()
+    assert len(data['data']) == 5
+    assert data['data'][0]['id'] == form113_sample['id']
+
+    url = PREFIX + '/data?owner=root&model=form/comment'
+    resp = await client.get(url)
+    assert resp.status == 400
+    text = await resp.text()
+    assert 'only one filter' in text
+
+    url = PREFIX + '/data?tender=zzz'
+    resp = await client.get(url)
+    assert resp.status == 400
+    text = await resp.text()
+    assert 'bad tender filter' in text
+
+    url = PREFIX + '/stats?owner=root'
+    resp = await client.get(url)
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['data']['count'] == 5
+    assert data['data']['models']['admin/schema'] == 2
+
+    url = PREFIX + '/stats?model=form/comment'
+    resp = await client.get(url)
+    assert resp.status == 200
+    data = await resp.json()
+    assert data['data']['count'] == 1
+
+    url = PREFIX + '/stats'
+    resp = await client.get(url)
+    assert resp.status == 400
+
     url = PREFIX + '/data/' + (root_key['id'] * 150)
     resp = await client.get(url)
     assert resp.status == 400
@@ -479,12 +960,33 @@ async def api_tests(test_client, loop, config):
         comment_schema['envelope']['payload']['schema']['title']
 
     url = PREFIX + '/data/' + comment_sample['id']
-    resp = await client.get(url)
+    resp = await client.get(url, headers={'Accept-Encoding': 'identity'})
     assert resp.status == 200
     data = await resp.json()
     assert data['data'][0]['envelope']['payload']['comment'] == \
         comment_sample['envelope']['payload']['comment']
 
+    etag = resp.headers['ETag']
+    assert etag == '"{}"'.format(comment_sample['id'])
+    resp = await client.get(url, headers={'If-None-Match': etag})
+    assert resp.status == 304
+    resp = await client.get(url, headers={'If-None-Match': '*'})
+    assert resp.status == 304
+    resp = await client.get(PREFIX + '/data/' + 'f' * 32, headers={'If-None-Match': '*'})
+    assert resp.status == 404
+
+    if 'compress' in app:
+        for _ in range(2):
+            resp = await client.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert resp.status == 200
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert resp.headers['Vary'] == 'Accept-Encoding'
+            data = await resp.json()
+            assert data['data'][0]['id'] == comment_sample['id']
+        assert app['compress'].stats()['cache_hits'] >= 1
+        resp = await client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+        assert resp.status == 304
+
     url = "{}/data/{},{}".format(PREFIX, comment_sample['id'],
         comment_schema['id'])
     resp = await client.get(url)
@@ -492,6 +994,13 @@ async def api_tests(test_client, loop, config):
     data = await resp.json()
     assert len(data['data']) == 2
 
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+    text = await resp.text()
+    assert 'dozorro_request_seconds_count{route="item_view",method="GET"}' in text
+    assert 'dozorro_put_stage_seconds_count{stage="validate_envelope"}' in text
+    assert 'dozorro_engine_seconds_count{method="get_list"}' in text
+
     await shutdown_app(app)
 
 
@@ -596,3 +1105,31 @@ def test_verify_data_couch(loop):
 
 async def test_verify_api_couch(loop):
     await verify_api_data(loop, "tests/api_couch.yaml")
+
+
+# # # start test sqlite # # #
+
+
+def test_create_sqlite(loop):
+    os.makedirs(TMPDIR, exist_ok=True)
+    create_cdb("tests/api_sqlite.yaml")
+
+
+async def test_put_sqlite(loop):
+    await put_data(loop, "tests/api_sqlite.yaml")
+
+
+async def test_api_sqlite(test_client, loop):
+    await api_tests(test_client, loop, "tests/api_sqlite.yaml")
+
+
+def test_wsgi_sqlite(loop):
+    wsgi_import(loop, "tests/api_sqlite.yaml")
+
+
+def test_verify_data_sqlite(loop):
+    verify_database(loop, "tests/api_sqlite.yaml")
+
+
+async def test_verify_api_sqlite(loop):
+    await verify_api_data(loop, "tests/api_sqlite.yaml")
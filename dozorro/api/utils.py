@@ -1,13 +1,20 @@
+import os
 import glob
+import hashlib
 import yaml
+import asyncio
 import aiohttp
-import iso8601
 import logging
 import logging.config
 import rapidjson as json
+from time import monotonic
+from collections import OrderedDict
+from dozorro.api.validate import Keyring, compile_schema, fetch_tender
 
 logger = logging.getLogger(__name__)
 
+SNAPSHOT_VERSION = 3
+
 
 class Client(object):
     session = None
@@ -60,50 +67,119 @@ class Client(object):
         return data['data']
 
 
+class TenderCache(object):
+    """TTL cache of tenders which also coalesces concurrent fetches
+
+    Failed lookups are cached too but for shorter negative_ttl.
+    """
+    def __init__(self, fetch, ttl=300, negative_ttl=30, max_size=10000):
+        self.fetch = fetch
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self.max_size = int(max_size)
+        self.items = OrderedDict()
+        self.pending = dict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, tender_id, app, refresh=False):
+        entry = self.items.get(tender_id)
+        if entry and not refresh and entry[0] > monotonic():
+            self.hits += 1
+            if isinstance(entry[1], Exception):
+                raise entry[1]
+            return entry[1]
+        if tender_id in self.pending:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            coro = self.fetch_and_store(tender_id, app)
+            self.pending[tender_id] = asyncio.ensure_future(coro)
+        return await asyncio.shield(self.pending[tender_id])
+
+    async def fetch_and_store(self, tender_id, app):
+        try:
+            tender = await self.fetch(tender_id, app)
+            self.store(tender_id, tender, self.ttl)
+            return tender
+        except ValueError as e:
+            self.store(tender_id, e, self.negative_ttl)
+            raise
+        finally:
+            self.pending.pop(tender_id, None)
+
+    def store(self, tender_id, value, ttl):
+        self.items.pop(tender_id, None)
+        self.items[tender_id] = (monotonic() + ttl, value)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced
+        }
+
+
 async def create_client(app, loop):
     if 'tenders' in app['config']:
         config = app['config']['tenders']
         app['tenders'] = await Client.create(config, loop)
+        if config.get('cache'):
+            app['tenders_cache'] = TenderCache(fetch_tender, **config['cache'])
     if 'archive' in app['config']:
         config = app['config']['archive']
         app['archive'] = await Client.create(config, loop)
 
 
+def read_json(filename):
+    with open(filename, 'rb') as fp:
+        return json.loads(fp.read())
+
+
+async def read_json_files(filenames):
+    """Read and parse files concurrently in default executor"""
+    loop = asyncio.get_event_loop()
+    return await asyncio.gather(*[loop.run_in_executor(None, read_json, fn)
+                                  for fn in filenames])
+
+
 async def load_keyring(app):
     path = app['config']['keyring']
-    keyring = {}
-    for fn in glob.glob(path + '/*.json'):
-        logger.debug('Load pubkey {}'.format(fn))
-        with open(fn, 'rb') as fp:
-            data = json.loads(fp.read())
+    filenames = sorted(glob.glob(path + '/*.json'))
+    logger.debug('Load pubkeys {}'.format(filenames))
+    docs = await read_json_files(filenames)
+    for data in docs:
         model = data['envelope']['model']
         assert model == 'admin/pubkey', 'bad key model'
-        payload = data['envelope']['payload']
-        payload['validSince'] = iso8601.parse_date(payload['validSince'])
-        payload['validTill'] = iso8601.parse_date(payload['validTill'])
-        owner = payload['owner']
-        if owner not in keyring:
-            keyring[owner] = []
-        await app['db'].check_exists(data['id'])
-        keyring[owner].append(payload)
+    await app['db'].check_exists_many([data['id'] for data in docs])
+    add_admin_ids(app, docs)
+    set_keyring(app, [data['envelope']['payload'] for data in docs])
+
+
+def set_keyring(app, payloads):
+    keyring = Keyring()
+    for payload in payloads:
+        keyring.add(payload)
     app['keyring'] = keyring
+    app['keyring_payloads'] = payloads
     logger.info('Loaded {} keys'.format(len(keyring)))
 
 
 async def load_schemas(app):
     path = app['config']['schemas']
-    schemas = {}
+    filenames = sorted(glob.glob(path + '/*.json'))
+    logger.debug('Load schemas {}'.format(filenames))
+    docs = await read_json_files(filenames)
     comment = {}
-    for fn in glob.glob(path + '/comment.json'):
-        logger.debug('Load comment {}'.format(fn))
-        with open(fn, 'rb') as fp:
-            root = json.loads(fp.read())
-        payload = root['envelope']['payload']
-        comment = payload['schema']
-    for fn in glob.glob(path + '/*.json'):
-        logger.debug('Load schema {}'.format(fn))
-        with open(fn, 'rb') as fp:
-            root = json.loads(fp.read())
+    for fn, root in zip(filenames, docs):
+        if fn.endswith('/comment.json'):
+            comment = root['envelope']['payload']['schema']
+    schemas = {}
+    for root in docs:
         model = root['envelope']['model']
         assert model == 'admin/schema', 'bad schema model'
         payload = root['envelope']['payload']
@@ -111,12 +187,92 @@ async def load_schemas(app):
         if 'definitions' not in data:
             data['definitions'] = comment['definitions']
         model, schema = payload['model'].split('/')
-        await app['db'].check_exists(root['id'])
         schemas[schema] = data
+    await app['db'].check_exists_many([root['id'] for root in docs])
+    add_admin_ids(app, docs)
+    set_schemas(app, schemas)
+
+
+def add_admin_ids(app, docs):
+    # admin items stored only in database are applied by AdminWatcher
+    if 'admin_ids' not in app:
+        app['admin_ids'] = set()
+    app['admin_ids'].update(data['id'] for data in docs)
+
+
+def set_schemas(app, schemas):
+    backend = app['config'].get('schema_backend')
+    validators = {name: compile_schema(data, backend) for name, data in schemas.items()}
     app['schemas'] = schemas
+    app['validators'] = validators
     logger.info('Loaded {} schemas'.format(len(schemas)))
 
 
+def files_fingerprint(app):
+    """Names, sizes and mtimes of keyring and schemas files and database config hash
+
+    Snapshot file is written to disk, so database config which may hold
+    credentials goes there only as a hash.
+    """
+    config = app['config']
+    files = list()
+    for path in (config['keyring'], config['schemas']):
+        for fn in sorted(glob.glob(path + '/*.json')):
+            st = os.stat(fn)
+            files.append([fn, st.st_size, st.st_mtime_ns])
+    database = json.dumps(config['database'], sort_keys=True).encode()
+    return {'database': hashlib.sha256(database).hexdigest(), 'files': files}
+
+
+def read_snapshot(filename, fingerprint):
+    try:
+        state = read_json(filename)
+    except (OSError, ValueError) as e:
+        logger.info('Startup snapshot not loaded: {}'.format(e))
+        return None
+    if state.get('version') != SNAPSHOT_VERSION or state.get('fingerprint') != fingerprint:
+        logger.info('Startup snapshot {} is outdated'.format(filename))
+        return None
+    return state
+
+
+def write_snapshot(filename, state):
+    # write to temporary file first, other workers may read it right now
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wt') as fp:
+        fp.write(json.dumps(state, ensure_ascii=False))
+    os.replace(tmp_filename, filename)
+
+
+async def load_keyring_schemas(app):
+    """Load keyring and schemas concurrently or from startup snapshot
+
+    Snapshot is written after files were parsed and checked against the
+    database, it is used while files and database config stay the same.
+    It holds key payloads and raw schemas only, validators are compiled on
+    every load because compiled functions can't be serialized.
+    """
+    snapshot = app['config'].get('startup_snapshot')
+    fingerprint = files_fingerprint(app) if snapshot else None
+    state = read_snapshot(snapshot, fingerprint) if snapshot else None
+    if state:
+        app['admin_ids'] = set(state['admin_ids'])
+        set_keyring(app, state['keyring'])
+        set_schemas(app, state['schemas'])
+        logger.info('Loaded startup snapshot {}'.format(snapshot))
+        return
+    await asyncio.gather(load_keyring(app), load_schemas(app))
+    if snapshot:
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'fingerprint': fingerprint,
+            'admin_ids': sorted(app['admin_ids']),
+            'keyring': app['keyring_payloads'],
+            'schemas': app['schemas'],
+        }
+        write_snapshot(snapshot, state)
+
+
 def load_config(filename, app=None, configure_logging=True):
     with open(filename) as fp:
         config = yaml.safe_load(fp)
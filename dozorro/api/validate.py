@@ -6,19 +6,73 @@ import hashlib
 import ed25519
 import iso8601
 import logging
+import threading
 import jsonschema
+import multiprocessing
+from time import perf_counter
+from bisect import bisect_right
 from rapidjson import dumps
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dozorro.api import metrics
 
 logger = logging.getLogger(__name__)
 
 TZ = pytz.timezone(os.environ.get('TZ', 'Europe/Kiev'))
 
+verify_stats = {'count': 0, 'time': 0.0}
+# updated from validate executor threads too
+verify_lock = threading.Lock()
+
+STAGE_ENVELOPE = (('stage', 'validate_envelope'),)
+STAGE_SCHEMA = (('stage', 'validate_schema'),)
+STAGE_REFERENCES = (('stage', 'validate_references'),)
+
 
 class ValidateError(ValueError):
     pass
 
 
+class Keyring(dict):
+    """Owner keys sorted by validSince with already parsed verifying keys
+
+    Beside keys list each owner has validSince list for bisect and running
+    maximum of validTill to stop scan when no older key can be valid.
+    """
+    def __init__(self):
+        super().__init__()
+        self.since = dict()
+        self.till = dict()
+
+    def add(self, payload):
+        keydata = dict(payload)
+        for name in ('validSince', 'validTill'):
+            if isinstance(keydata[name], str):
+                keydata[name] = iso8601.parse_date(keydata[name])
+        keydata['verifyingKey'] = ed25519.VerifyingKey(keydata['publicKey'], encoding='hex')
+        owner = keydata['owner']
+        keys = self.setdefault(owner, [])
+        since = self.since.setdefault(owner, [])
+        n = bisect_right(since, keydata['validSince'])
+        keys.insert(n, keydata)
+        since.insert(n, keydata['validSince'])
+        till = list()
+        for key in keys:
+            till.append(max(till[-1], key['validTill']) if till else key['validTill'])
+        self.till[owner] = till
+        return keydata
+
+    def find(self, owner, date):
+        keys = self.get(owner, [])
+        till = self.till.get(owner, [])
+        n = bisect_right(self.since.get(owner, []), date)
+        for i in range(n - 1, -1, -1):
+            if till[i] < date:
+                break
+            if date <= keys[i]['validTill']:
+                yield keys[i]
+
+
 def hash_id(bdata):
     h1 = hashlib.sha256(bdata).digest()
     h2 = hashlib.sha256(h1).hexdigest()
@@ -52,37 +106,56 @@ def validate_envelope(data, keyring, check_date=True):
         last_exc = None
         if owner not in keyring:
             raise KeyError('key not found')
-        for keydata in keyring[owner]:
-            if keydata['validSince'] <= env_date <= keydata['validTill']:
-                vkey_hex = keydata['publicKey']
-                vk = ed25519.VerifyingKey(vkey_hex, encoding='hex')
-                try:
-                    vk.verify(sign, bin_data, encoding='base64')
-                    logger.info("Sign verified {} pubkey {}/{}".format(
-                                data['id'], keydata['owner'], vkey_hex[:8]))
-                    verified = True
-                    break
-                except ed25519.BadSignatureError as exc:
-                    last_exc = exc
+        started = perf_counter()
+        for keydata in keyring.find(owner, env_date):
+            try:
+                keydata['verifyingKey'].verify(sign, bin_data, encoding='base64')
+                logger.info("Sign verified {} pubkey {}/{}".format(
+                            data['id'], keydata['owner'], keydata['publicKey'][:8]))
+                verified = True
+                break
+            except ed25519.BadSignatureError as exc:
+                last_exc = exc
+        with verify_lock:
+            verify_stats['count'] += 1
+            verify_stats['time'] += perf_counter() - started
         if not verified:
             raise last_exc if last_exc else IndexError('key not found')
     except Exception as e:
         raise ValidateError('sign not verified') from e
 
 
-async def validate_tender_reference(tender_id, app):
+async def fetch_tender(tender_id, app):
     client = app['tenders']
     for n in range(5):
         try:
-            tender = await client.get_tender(tender_id)
+            metrics.inc('dozorro_tenders_requests_total')
+            with metrics.timer('dozorro_tenders_seconds', ()):
+                tender = await client.get_tender(tender_id)
             break
         except aiohttp.ClientError as exc:
             if exc.code // 100 == 4 or n == 4:
                 if 'archive' in app and client != app['archive']:
+                    metrics.inc('dozorro_tenders_fallbacks_total')
                     client = app['archive']
                     continue
                 raise ValidateError('tender not found')
+            metrics.inc('dozorro_tenders_retries_total')  # pragma: no cover
             await asyncio.sleep(n + 1)  # pragma: no cover
+    return tender
+
+
+async def validate_tender_reference(tender_id, app, refresh=False):
+    tender = None
+    if 'mirror' in app and not refresh:
+        tender = await app['mirror'].get(tender_id)
+    if not tender:
+        if 'tenders_cache' in app:
+            tender = await app['tenders_cache'].get(tender_id, app, refresh)
+        else:
+            tender = await fetch_tender(tender_id, app)
+        if 'mirror' in app:
+            await app['mirror'].store(tender)
     if tender.get('mode', '') == 'test':
         if not app['config']['tenders'].get('test'):
             raise ValidateError('reference tender in mode=test')
@@ -91,6 +164,10 @@ async def validate_tender_reference(tender_id, app):
 
 async def validate_contract_reference(contract_id, tender_id, app):
     tender = await validate_tender_reference(tender_id, app)
+    cached = 'tenders_cache' in app or 'mirror' in app
+    if cached and not [c for c in tender.get('contracts', []) if c['id'] == contract_id]:
+        # contract may be signed after tender was cached
+        tender = await validate_tender_reference(tender_id, app, refresh=True)
     assert tender.get('contracts', None), 'tender has no contracts'
     assert [c for c in tender['contracts'] if c['id'] == contract_id], 'contract not found'
 
@@ -106,17 +183,166 @@ async def validate_references(payload, formschema, app):
                 await app['db'].check_exists(payload[key], model=value['reference'])
 
 
-async def validate_schema(envelope, app, check_refs=True):
+def compile_schema(schema, backend=None):
+    """Check schema and return validate(payload) function for it"""
+    if backend == 'fastjsonschema':
+        import fastjsonschema
+        return fastjsonschema.compile(schema)
+    elif backend and backend != 'jsonschema':
+        raise ValueError('Unknown schema backend: %s' % backend)
+
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+
+    def validate(payload):
+        error = jsonschema.exceptions.best_match(validator.iter_errors(payload))
+        if error is not None:
+            raise error
+    return validate
+
+
+def validate_payload(envelope, app):
     model, schema = envelope['model'].split('/', 1)
-    payload = envelope['payload']
     if model not in ('form', 'admin'):
         raise ValidateError('bad model name')
     if model == 'admin':
         assert envelope['owner'] == 'root'
-        return
+        return None
     if schema not in app['schemas']:
         raise ValidateError('unknown schema name "{}"'.format(schema))
-    formschema = app['schemas'][schema]
-    jsonschema.validate(payload, formschema)
-    if check_refs:
-        await validate_references(payload, formschema, app)
+    app['validators'][schema](envelope['payload'])
+    return app['schemas'][schema]
+
+
+async def validate_schema(envelope, app, check_refs=True):
+    formschema = validate_payload(envelope, app)
+    if formschema and check_refs:
+        await validate_references(envelope['payload'], formschema, app)
+
+
+def check_document(data, app):
+    """CPU bound part of validation, safe to run outside of event loop
+
+    Returns envelope and payload validation times.
+    """
+    started = perf_counter()
+    validate_envelope(data, app['keyring'])
+    checked = perf_counter()
+    validate_payload(data['envelope'], app)
+    return checked - started, perf_counter() - checked
+
+
+async def validate_document(data, app):
+    if 'validate_executor' in app:
+        times = await app['validate_executor'].run(data, app)
+    else:
+        times = check_document(data, app)
+    metrics.observe('dozorro_put_stage_seconds', STAGE_ENVELOPE, times[0])
+    metrics.observe('dozorro_put_stage_seconds', STAGE_SCHEMA, times[1])
+    envelope = data['envelope']
+    model, schema = envelope['model'].split('/', 1)
+    if model == 'form':
+        with metrics.timer('dozorro_put_stage_seconds', STAGE_REFERENCES):
+            await validate_references(envelope['payload'], app['schemas'][schema], app)
+
+
+# keyring and schemas of process pool worker, see init_worker
+worker_app = dict()
+
+
+def init_worker(keys, schemas, schema_backend):
+    keyring = Keyring()
+    for keydata in keys:
+        keyring.add(keydata)
+    worker_app['keyring'] = keyring
+    worker_app['schemas'] = schemas
+    worker_app['validators'] = {name: compile_schema(data, schema_backend)
+                                for name, data in schemas.items()}
+
+
+def check_in_worker(data):
+    try:
+        return check_document(data, worker_app)
+    except jsonschema.exceptions.ValidationError as e:
+        # original error refers schema internals and can't be pickled
+        raise jsonschema.exceptions.ValidationError(e.message) from None
+
+
+class ValidateExecutor(object):
+    """Run check_document in thread or process pool off the event loop
+
+    Process pool workers get their own copy of keyring and schemas, pool
+    is restarted when app['keyring'] or app['schemas'] is replaced. Pool is
+    created from running server, so workers are not forked from it but
+    started by forkserver (spawn where it is not available) and don't
+    inherit event loop and listening sockets.
+    """
+    def __init__(self, type='thread', workers=2, context=None):
+        if type not in ('thread', 'process'):
+            raise ValueError('Unknown executor type: %s' % type)
+        if context is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = 'forkserver' if 'forkserver' in methods else 'spawn'
+        if context == 'fork':
+            raise ValueError('fork context is not safe for validate executor')
+        self.type = type
+        self.workers = int(workers)
+        self.mp_context = multiprocessing.get_context(context)
+        self.pool = None
+        self.state = None
+        self.pending = 0
+        self.max_pending = 0
+        self.count = 0
+        self.wait_time = 0.0
+        self.exec_time = 0.0
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def get_pool(self, app):
+        if self.type == 'thread':
+            if not self.pool:
+                self.pool = ThreadPoolExecutor(self.workers)
+            return self.pool
+        state = (app['keyring'], app['schemas'])
+        if not self.state or self.state[0] is not state[0] or self.state[1] is not state[1]:
+            self.close()
+            keys = [{k: v for k, v in keydata.items() if k != 'verifyingKey'}
+                    for owner_keys in app['keyring'].values() for keydata in owner_keys]
+            schema_backend = app['config'].get('schema_backend')
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=self.mp_context,
+                initializer=init_worker, initargs=(keys, app['schemas'], schema_backend))
+            self.state = state
+        return self.pool
+
+    async def run(self, data, app):
+        loop = asyncio.get_event_loop()
+        started = perf_counter()
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        try:
+            if self.type == 'thread':
+                times = await loop.run_in_executor(self.get_pool(app),
+                    check_document, data, app)
+            else:
+                times = await loop.run_in_executor(self.get_pool(app),
+                    check_in_worker, data)
+        finally:
+            self.pending -= 1
+        exec_time = sum(times)
+        self.count += 1
+        self.exec_time += exec_time
+        self.wait_time += perf_counter() - started - exec_time
+        return times
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'count': self.count,
+            'wait_time': self.wait_time,
+            'exec_time': self.exec_time
+        }
@@ -1,17 +1,89 @@
 import re
+import asyncio
+import logging
 from rapidjson import loads, dumps
-from aiohttp.web import HTTPNotFound, HTTPMethodNotAllowed, View, json_response
-from dozorro.api.validate import ValidateError, validate_envelope, validate_schema
+from aiohttp.web import HTTPNotFound, HTTPMethodNotAllowed, HTTPServiceUnavailable, Response, \
+    StreamResponse, View, json_response
+from dozorro.api import compress, metrics
+from dozorro.api.backend import LIST_FILTERS, STATS_KINDS, dump_item
+from dozorro.api.middleware import VALIDATE_ERRORS, error_message
+from dozorro.api.validate import ValidateError, hash_id, validate_document
 
 HEX_LIST = re.compile(r'^[0-9a-f,]{32,3300}$')
+FILTER_VALUE = {
+    'owner': re.compile(r'^[\w .@-]{1,100}$'),
+    'model': re.compile(r'^\w+/\w+$'),
+    'tender': re.compile(r'^[0-9a-f]{32}$'),
+    'day': re.compile(r'^\d{4}-\d{2}-\d{2}$'),
+}
+
+logger = logging.getLogger(__name__)
+
+STAGE_PUT_ITEM = (('stage', 'put_item'),)
+STAGE_PUT_MANY = (('stage', 'put_many'),)
+
+CACHE_CONTROL = {
+    'item_view': 'public, max-age=31536000',
+}
+
+
+def cache_headers(request):
+    route_name = request.match_info.route.name
+    config = request.app['config'].get('cache_control') or {}
+    value = config.get(route_name, CACHE_CONTROL.get(route_name))
+    return [('Cache-Control', value)] if value else []
+
+
+def etag_matches(request, etag, exists=False):
+    """Check If-None-Match, * matches only items known to exist"""
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        # compressed variants are tagged with encoding suffix
+        tag = compress.etag_base(tag)
+        if tag == etag or (tag == '*' and exists):
+            return True
+    return False
+
+
+async def validate_item(data, app, ua=None):
+    if ua and ua.find(data['envelope']['owner']) < 0:
+        raise ValidateError('User-Agent must include owner')
+    await validate_document(data, app)
+
+
+async def get_many_json(db, many_ids):
+    if hasattr(db, 'get_many_raw'):
+        return await db.get_many_raw(many_ids)
+    docs = {doc['id']: doc for doc in await db.get_many(many_ids)}
+    return [dump_item(docs[i]) for i in many_ids if i in docs]
+
+
+def list_filters(args):
+    filters = dict()
+    for name in LIST_FILTERS:
+        value = args.get(name)
+        if value is None:
+            continue
+        if not FILTER_VALUE[name].match(value):
+            raise ValueError('bad {} filter'.format(name))
+        filters[name] = value
+    if len(filters) > 1:
+        raise ValueError('only one filter allowed')
+    return filters
 
 
 class ListView(View):
     @staticmethod
-    def offset_args(offset, reverse):
+    def offset_args(offset, reverse, filters=None):
+        args = dict(filters or {}, offset=offset)
         if reverse:
-            return {'offset': offset, 'reverse': '1'}
-        return {'offset': offset}
+            args['reverse'] = '1'
+        return args
 
     async def get(self):
         args = self.request.query
@@ -20,14 +92,142 @@ class ListView(View):
         reverse = bool(args.get('reverse', 0))
         if limit < 1 or limit > 1000:
             raise ValueError('bad limit')
+        filters = list_filters(args)
         db = self.request.app['db']
         items_list, first, last = await db.get_list(
-            offset, limit, reverse)
+            offset, limit, reverse, filters=filters)
         resp = {'data': items_list}
         if first:
-            resp['prev_page'] = ListView.offset_args(first, not reverse)
+            resp['prev_page'] = ListView.offset_args(first, not reverse, filters)
         if last:
-            resp['next_page'] = ListView.offset_args(last, reverse)
+            resp['next_page'] = ListView.offset_args(last, reverse, filters)
+        headers = cache_headers(self.request)
+        return json_response(resp, headers=headers, dumps=dumps)
+
+
+class ExportView(View):
+    async def get(self):
+        args = self.request.query
+        offset = args.get('offset', '') or None
+        limit = int(args.get('limit', 0) or 100)
+        reverse = bool(args.get('reverse', 0))
+        if limit < 1 or limit > 100:
+            raise ValueError('bad limit')
+        filters = list_filters(args)
+        db = self.request.app['db']
+        items_list, _, last = await db.get_list(offset, limit, reverse, filters=filters)
+
+        resp = StreamResponse(headers=cache_headers(self.request))
+        resp.content_type = 'application/x-ndjson'
+        await resp.prepare(self.request)
+
+        # write one page at a time, each followed by resumable offset line
+        while items_list:
+            many_ids = [item['id'] for item in items_list]
+            lines = await get_many_json(db, many_ids)
+            next_page = ListView.offset_args(last, reverse, filters)
+            lines.append(dumps({'next_page': next_page}).encode())
+            lines.append(b'')
+            await resp.write(b'\n'.join(lines))
+            if not last:
+                break
+            items_list, _, last = await db.get_list(last, limit, reverse, filters=filters)
+
+        await resp.write_eof()
+        return resp
+
+
+class StatsView(View):
+    """Counters of stored items by one of tender, owner, model or day"""
+    async def get(self):
+        args = self.request.query
+        kinds = [kind for kind in STATS_KINDS if kind in args]
+        if len(kinds) != 1:
+            raise ValueError('one of {} required'.format(', '.join(STATS_KINDS)))
+        kind, key = kinds[0], args[kinds[0]]
+        if not FILTER_VALUE[kind].match(key):
+            raise ValueError('bad {} filter'.format(kind))
+        models = await self.request.app['db'].get_stats(kind, key)
+        resp = {'data': {kind: key, 'count': sum(models.values()), 'models': models}}
+        headers = cache_headers(self.request)
+        return json_response(resp, headers=headers, dumps=dumps)
+
+
+class ChangesView(View):
+    """Server-Sent Events stream of new items from app['changes'] hub"""
+    async def get(self):
+        hub = self.request.app['changes']
+        docs = bool(self.request.query.get('docs', 0))
+        try:
+            sub = hub.subscribe(docs)
+        except OverflowError:
+            raise HTTPServiceUnavailable()
+        resp = StreamResponse(headers={'Cache-Control': 'no-cache',
+                                       'X-Accel-Buffering': 'no'})
+        resp.content_type = 'text/event-stream'
+        try:
+            await resp.prepare(self.request)
+            await resp.write(b'retry: 5000\n\n')
+            while True:
+                try:
+                    data = await asyncio.wait_for(sub.get(), hub.heartbeat)
+                except asyncio.TimeoutError:
+                    data = b': ping\n\n'
+                if data is None:
+                    if sub.overflow:
+                        await resp.write(b'event: overflow\ndata: {}\n\n')
+                    break
+                await resp.write(data)
+            await resp.write_eof()
+        except ConnectionResetError:
+            logger.info('Changes subscriber disconnected')
+        finally:
+            hub.unsubscribe(sub)
+        return resp
+
+
+class BulkView(View):
+    async def validate_line(self, line, semaphore):
+        try:
+            data = loads(line)
+            item_id = data['id']
+        except VALIDATE_ERRORS as e:
+            return None, {'id': None, 'status': 'error', 'error': error_message(e)}
+        try:
+            async with semaphore:
+                await validate_item(data, self.request.app, self.request.headers.get('User-Agent'))
+        except VALIDATE_ERRORS as e:
+            logger.error('Bulk item {} rejected {}'.format(item_id, error_message(e)))
+            return None, {'id': item_id, 'status': 'error', 'error': error_message(e)}
+        return data, {'id': item_id, 'status': 'validated'}
+
+    async def post(self):
+        app = self.request.app
+        if app['config'].get('readonly'):
+            raise HTTPMethodNotAllowed(self.request.method, ['GET'])
+        ct = self.request.headers.get('Content-Type')
+        if not ct or not ct.startswith('application/x-ndjson'):
+            raise ValidateError('Content-Type must be application/x-ndjson')
+
+        self.request.raw_body_data = await self.request.content.read()
+        lines = [line for line in self.request.raw_body_data.splitlines() if line.strip()]
+        if len(lines) > int(app['config'].get('bulk_limit', 1000)):
+            raise ValidateError('too many items')
+
+        semaphore = asyncio.Semaphore(int(app['config'].get('bulk_concurrency', 10)))
+        checked = await asyncio.gather(*[self.validate_line(line, semaphore) for line in lines])
+        items = [data for data, _ in checked if data]
+        result = [status for _, status in checked]
+
+        if items and not self.request.query.get('nosave', False):
+            with metrics.timer('dozorro_put_stage_seconds', STAGE_PUT_MANY):
+                inserted = iter(await app['db'].put_many(items))
+            for status in result:
+                if status['status'] == 'validated':
+                    status['status'] = next(inserted)
+
+        created = len([s for s in result if s['status'] == 'created'])
+        resp = {'data': result, 'created': created}
         return json_response(resp, dumps=dumps)
 
 
@@ -43,15 +243,28 @@ class ItemView(View):
         if len(many_ids) > 100:
             raise ValidateError('too many ids')
 
+        # items ids are content hashes, so the ids list is a strong validator
+        etag = many_ids[0] if len(many_ids) == 1 else hash_id(item_id.encode())
+        etag = '"{}"'.format(etag)
+        headers = cache_headers(self.request)
+        if etag_matches(self.request, etag):
+            headers.append(('ETag', etag))
+            return Response(status=304, headers=headers)
+
         db = self.request.app['db']
-        items_list = await db.get_many(many_ids)
+        items_list = await get_many_json(db, many_ids)
         if not items_list:
             raise HTTPNotFound()
 
-        resp = {'data': items_list}
-        # TODO make cache-control configurable
-        headers = [('Cache-Control', 'public, max-age=31536000')]
-        return json_response(resp, headers=headers, dumps=dumps)
+        # response with missing items may change later, don't tag it
+        if len(items_list) == len(many_ids):
+            headers.append(('ETag', etag))
+            if etag_matches(self.request, etag, exists=True):
+                return Response(status=304, headers=headers)
+
+        # items are already serialized, just join them into envelope
+        body = b'{"data":[' + b','.join(items_list) + b']}'
+        return Response(body=body, headers=headers, content_type='application/json')
 
     async def put(self):
         if self.request.app['config'].get('readonly'):
@@ -68,19 +281,15 @@ class ItemView(View):
         if item_id != data['id']:
             raise ValidateError('id in uri and data mismatch')
 
-        if ua and ua.find(data['envelope']['owner']) < 0:
-            raise ValidateError('User-Agent must include owner')
-
         app = self.request.app
-
-        validate_envelope(data, app['keyring'])
-        await validate_schema(data['envelope'], app)
+        await validate_item(data, app, ua)
 
         if self.request.query.get('nosave', False):
             resp = {'validated': 1, 'created': 0}
             return json_response(resp, dumps=dumps)
 
-        await app['db'].put_item(data)
+        with metrics.timer('dozorro_put_stage_seconds', STAGE_PUT_ITEM):
+            await app['db'].put_item(data)
         url = app.router['item_view'].url_for(item_id=item_id)
         headers = [('Location', url.path)]
         resp = {'created': 1}
@@ -89,4 +298,10 @@ class ItemView(View):
 
 def setup_routes(app, prefix='/api/v1'):
     app.router.add_route('*', prefix + '/data', ListView, name='list_view')
+    app.router.add_route('POST', prefix + '/data/_bulk', BulkView, name='bulk_view')
     app.router.add_route('*', prefix + '/data/{item_id}', ItemView, name='item_view')
+    app.router.add_route('GET', prefix + '/export', ExportView, name='export_view')
+    if app['config'].get('stats'):
+        app.router.add_route('GET', prefix + '/stats', StatsView, name='stats_view')
+    if 'changes' in app:
+        app.router.add_route('GET', prefix + '/changes', ChangesView, name='changes_view')
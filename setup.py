@@ -17,7 +17,9 @@ requires = [
 entry_points = {
     'console_scripts': [
         'cdb_init=dozorro.api.console:cdb_init',
+        'cdb_migrate=dozorro.api.console:cdb_migrate',
         'cdb_put=dozorro.api.console:cdb_put',
+        'cdb_stats=dozorro.api.console:cdb_stats',
         'cdb_verify=dozorro.api.console:cdb_verify',
     ]
 }